@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# Benchmark of the bencode decoder against the old token generator based one,
+# on synthetic metafiles like the ones that are slow to load in practice.
+#
+#   python benchmarks/bencode_decode.py [--pieces N] [--files N] [--repeat N]
+import os
+import sys
+import time
+import hashlib
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import bencode
+from bencode import BEncodeDecodeError
+
+# The decoder as it was before - a generator yielding a token per character,
+# parsed recursively. Kept here verbatim as the baseline.
+## tokenize raw bencode bytestring
+def tokenize_bencode(bencode):
+    index = 0
+    number = ""
+    while index < len(bencode):
+        # d, l, i
+        # return the character as a bytestring
+        if bencode[index] in [100, 108, 105]:
+            yield bytes(chr(bencode[index]), "utf8")
+
+        # 0, 1, 2, 3, 4, 5, 6, 7, 8, 9, -
+        # store the number in a string to be decoded
+        elif (48 <= bencode[index] <= 57) or bencode[index] == 45:
+            number += chr(bencode[index])
+
+        # :
+        # colon means number has the length of the bytestring 
+        # return the bytestring between "s" and "e" tokens for future ease
+        elif bencode[index] == 58:
+            index += 1
+            byte_string_length = int(number)
+            byte_string =  bencode[(index):(byte_string_length + index)]
+
+            index += byte_string_length - 1
+            number = ""
+
+            yield b"s"
+            yield byte_string
+            yield b"e"
+
+        # e
+        # if number has any value in it, it must be of an int
+        # return the number and the e token
+        elif bencode[index] == 101:
+            if number:
+                yield bytes(number, "utf8")
+                number = ""
+
+            yield b"e"
+
+        # there are no other valid tokens. quit with an error.
+        else:
+            raise BEncodeDecodeError("Invalid BEncode")
+
+        index += 1
+
+## parse bencode tokens into an object
+def parse_token(token, gen):
+    
+    # parse int
+    if token == b'i':
+        number = int(next(gen))
+        if next(gen) != b"e":
+            raise BEncodeDecodeError("Invalid BEncode")
+
+        return number
+
+    # parse string - why the s token was added earlier
+    elif token == b's':
+        string = next(gen)
+        if next(gen) != b"e":
+            raise BEncodeDecodeError("this shouldn't be possible unless the tokenize function has been messed with :P")
+
+        # It may not be able to be parsed as a string - as in the hashes of the pieces
+        try:
+            return string.decode()
+        except UnicodeDecodeError:
+            return string
+
+    # parse list via recursively calling parse_token
+    elif token == b'l':
+        array = []
+        while (next_token := next(gen)) != b"e":
+            array.append(parse_token(next_token, gen))
+
+        return array
+
+     # parse dict via recursively calling parse_token
+    elif token == b'd':
+        items = []
+        while (next_token := next(gen)) != b"e":
+            items.append(parse_token(next_token, gen))
+        
+        return dict(zip(items[0::2], items[1::2]))
+
+
+def legacy_decode(data):
+    tokens = tokenize_bencode(data)
+    obj = parse_token(next(tokens), tokens)
+    for _ in tokens:
+        raise BEncodeDecodeError("Invalid Bencode - trailing tokens")
+
+    return obj
+
+## bencode by hand so the benchmark doesn't depend on the encoder
+def encode(obj):
+    if isinstance(obj, dict):
+        return b"d" + b"".join(encode(key) + encode(obj[key]) for key in sorted(obj)) + b"e"
+    elif isinstance(obj, list):
+        return b"l" + b"".join(encode(item) for item in obj) + b"e"
+    elif isinstance(obj, str):
+        return encode(obj.encode())
+    elif isinstance(obj, bytes):
+        return str(len(obj)).encode() + b":" + obj
+    return b"i" + str(obj).encode() + b"e"
+
+## a metafile with num_pieces piece hashes and num_files entries in the file list
+def make_metafile(num_pieces, num_files):
+    pieces = b"".join(hashlib.sha1(i.to_bytes(4, "big")).digest() for i in range(num_pieces))
+
+    info = {
+        b"name": b"benchmark",
+        b"piece length": 1 << 18,
+        b"pieces": pieces,
+    }
+
+    if num_files:
+        info[b"files"] = [{b"length": 1000 + i, b"path": [b"dir%d" % (i % 100), b"file%d.bin" % i]} for i in range(num_files)]
+    else:
+        info[b"length"] = num_pieces << 18
+
+    return encode({
+        b"announce": b"http://tracker.example/announce",
+        b"announce-list": [[b"http://tracker.example/announce"], [b"udp://tracker.example:6969"]],
+        b"creation date": 1700000000,
+        b"info": info,
+    })
+
+## a tracker response with num_peers compact peers
+def make_announce(num_peers):
+    return encode({
+        b"interval": 1800,
+        b"min interval": 900,
+        b"complete": 100,
+        b"incomplete": 20,
+        b"peers": os.urandom(6 * num_peers),
+    })
+
+## best time of repeat runs of fn(data)
+def best_time(fn, data, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(data)
+        elapsed = time.perf_counter() - start
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the bencode decoder to the old implementation")
+    parser.add_argument("--pieces", type=int, default=100000, help="number of pieces in the metafiles")
+    parser.add_argument("--files", type=int, default=20000, help="number of files in the multi-file metafile")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per case, the best one counts")
+    args = parser.parse_args()
+
+    cases = [
+        ("single file metafile", make_metafile(args.pieces, 0)),
+        ("multi file metafile", make_metafile(args.pieces, args.files)),
+        ("tracker response", make_announce(200)),
+    ]
+
+    print(f"{'case':<24}{'size':>12}{'old':>12}{'new':>12}{'speedup':>10}")
+
+    for (name, data) in cases:
+        if legacy_decode(data) != bencode.decode(data):
+            sys.exit(f"{name}: decoders disagree")
+
+        old = best_time(legacy_decode, data, args.repeat)
+        new = best_time(bencode.decode, data, args.repeat)
+
+        print(f"{name:<24}{len(data):>12}{old * 1000:>10.2f}ms{new * 1000:>10.2f}ms{old / new:>9.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# A stand-in tracker for local testing, speaking both http and the udp
+# protocol (BEP 15). Every announce is recorded and answered with the peers
+# it was given plus the ones that announced themselves.
+#
+#   python benchmarks/local_tracker.py [--port N] [--interval N] [--peer host:port ...]
+import os
+import sys
+import struct
+import socket
+import asyncio
+import argparse
+import urllib.parse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import bencode
+
+UDP_PROTOCOL_ID = 0x41727101980
+UDP_EVENTS = {0: "", 1: "completed", 2: "started", 3: "stopped"}
+
+class LocalTracker:
+    def __init__(self, peers=(), interval=1800, min_interval=None):
+        # (host, port) handed out to everyone, on top of announced peers
+        self.peers = list(peers)
+        self.interval = interval
+        self.min_interval = min_interval
+
+        # dict per announce with event, uploaded, downloaded, left, port and protocol
+        self.announces = []
+
+        # info_hash : set of (host, port) that announced
+        self.swarms = {}
+
+        self.servers = []
+
+    ## serve http on port and udp on the same port number
+    async def start(self, host="127.0.0.1", port=0):
+        loop = asyncio.get_running_loop()
+
+        server = await asyncio.start_server(self.handle_http, host, port)
+        port = server.sockets[0].getsockname()[1]
+
+        (transport, _) = await loop.create_datagram_endpoint(lambda: UDPTrackerProtocol(self), local_addr=(host, port))
+
+        self.servers = [server, transport]
+        self.port = port
+
+        return port
+
+    def close(self):
+        for server in self.servers:
+            server.close()
+
+    ## record an announce and return the compact (ipv4, ipv6) peers to answer it with
+    def announce(self, info_hash, host, port, event, uploaded, downloaded, left, protocol):
+        self.announces.append({"event": event, "uploaded": uploaded, "downloaded": downloaded,
+                               "left": left, "port": port, "protocol": protocol})
+
+        swarm = self.swarms.setdefault(info_hash, set())
+        if event == "stopped":
+            swarm.discard((host, port))
+        else:
+            swarm.add((host, port))
+
+        peers = self.peers + [peer for peer in swarm if peer != (host, port) and peer not in self.peers]
+
+        compact = {socket.AF_INET: [], socket.AF_INET6: []}
+        for (peer_host, peer_port) in peers:
+            family = socket.AF_INET6 if ":" in peer_host else socket.AF_INET
+            compact[family].append(socket.inet_pton(family, peer_host) + struct.pack(">H", peer_port))
+
+        return (b"".join(compact[socket.AF_INET]), b"".join(compact[socket.AF_INET6]))
+
+    async def handle_http(self, reader, writer):
+        try:
+            request = await reader.readuntil(b"\r\n\r\n")
+            target = request.split(b" ")[1].decode()
+            query = urllib.parse.parse_qs(urllib.parse.urlsplit(target).query, encoding="latin1")
+
+            def param(name, default=""):
+                return query.get(name, [default])[0]
+
+            (peers, peers6) = self.announce(param("info_hash").encode("latin1"), writer.get_extra_info("peername")[0],
+                                            int(param("port")), param("event"), int(param("uploaded", 0)),
+                                            int(param("downloaded", 0)), int(param("left", 0)), "http")
+
+            response = {"interval": self.interval, "peers": peers}
+            if peers6:
+                response["peers6"] = peers6
+            if self.min_interval is not None:
+                response["min interval"] = self.min_interval
+
+            body = bencode.encode(response)
+            writer.write(b"HTTP/1.0 200 OK\r\nContent-Length: %d\r\n\r\n" % len(body) + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, IndexError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+class UDPTrackerProtocol(asyncio.DatagramProtocol):
+    def __init__(self, tracker):
+        self.tracker = tracker
+        self.transport = None
+
+        self.connection_ids = set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) < 16:
+            return
+
+        (connection_id, action, transaction_id) = struct.unpack_from(">QII", data)
+
+        # connect
+        if action == 0 and connection_id == UDP_PROTOCOL_ID:
+            new_id = int.from_bytes(os.urandom(8), "big")
+            self.connection_ids.add(new_id)
+            self.transport.sendto(struct.pack(">IIQ", 0, transaction_id, new_id), addr)
+
+        # announce
+        elif action == 1 and len(data) >= 98:
+            if connection_id not in self.connection_ids:
+                self.transport.sendto(struct.pack(">II", 3, transaction_id) + b"unknown connection id", addr)
+                return
+
+            (info_hash, _, downloaded, left, uploaded, event, _, _, _, port) = struct.unpack_from(">20s20sQQQIIIiH", data, 16)
+            (peers, peers6) = self.tracker.announce(info_hash, addr[0], port, UDP_EVENTS.get(event, ""),
+                                                    uploaded, downloaded, left, "udp")
+
+            # the address family of the request decides which peers fit in the reply
+            if ":" in addr[0]:
+                peers = peers6
+
+            self.transport.sendto(struct.pack(">IIIII", 1, transaction_id, self.tracker.interval, 0, 0) + peers, addr)
+
+def main():
+    parser = argparse.ArgumentParser(description="Local http and udp tracker for testing")
+    parser.add_argument("--port", type=int, default=6969, help="port for both http and udp")
+    parser.add_argument("--interval", type=int, default=1800, help="announce interval handed out")
+    parser.add_argument("--peer", action="append", default=[], help="host:port handed to every client")
+    args = parser.parse_args()
+
+    peers = [(peer.rsplit(":", 1)[0], int(peer.rsplit(":", 1)[1])) for peer in args.peer]
+
+    async def run():
+        tracker = LocalTracker(peers, args.interval)
+        port = await tracker.start(port=args.port)
+        print(f"tracking on http://127.0.0.1:{port}/announce and udp://127.0.0.1:{port}")
+
+        await asyncio.Event().wait()
+
+    asyncio.run(run())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+# End-to-end download benchmark on a loopback swarm. A synthetic torrent is
+# generated, N seeders and a stand-in tracker are started on 127.0.0.1 and
+# src/main.py downloads from them as a subprocess. Reports throughput, CPU
+# time per MB, peak RSS and time to completion of the client only.
+#
+#   python benchmarks/swarm.py [--size MB] [--seeders N] [--latency MS] [--bandwidth MB/s] [--runs N]
+#
+# Seeders run in this process by default, where --latency and --bandwidth
+# shape every connection. With --seeder-mode client they are instances of
+# main.py --seed instead, which also exercises the upload path; --bandwidth
+# is then passed on as their upload limit and --latency doesn't apply.
+import os
+import sys
+import time
+import shlex
+import shutil
+import struct
+import asyncio
+import hashlib
+import argparse
+import tempfile
+import subprocess
+import statistics
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MAIN = os.path.join(HERE, "..", "src", "main.py")
+
+sys.path.insert(0, os.path.join(HERE, "..", "src"))
+
+import bencode
+from local_tracker import LocalTracker
+
+# Seconds a run may take before it counts as failed
+RUN_TIMEOUT = 600
+
+# A seeder that has every piece, serving blocks with optional latency and
+# bandwidth shaping per connection
+class Seeder:
+    def __init__(self, data, piece_length, info_hash, latency=0.0, bandwidth=0):
+        self.data = memoryview(data)
+        self.piece_length = piece_length
+        self.info_hash = info_hash
+        self.latency = latency
+        self.bandwidth = bandwidth
+
+        num_pieces = -(-len(data) // piece_length)
+        bitfield = bytearray((num_pieces + 7) >> 3)
+        for index in range(num_pieces):
+            bitfield[index >> 3] |= 1 << (7 - (index & 7))
+
+        self.bitfield = bytes(bitfield)
+        self.peer_id = b"-BS0000-" + os.urandom(12)
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    def close(self):
+        self.server.close()
+
+    async def handle(self, reader, writer):
+        loop = asyncio.get_running_loop()
+
+        # when the link is free again, for bandwidth shaping
+        link_free = loop.time()
+
+        try:
+            handshake = await reader.readexactly(68)
+            if handshake[28:48] != self.info_hash:
+                return
+
+            writer.write(b"\x13BitTorrent protocol" + bytes(8) + self.info_hash + self.peer_id)
+            writer.write(struct.pack(">IB", 1 + len(self.bitfield), 5) + self.bitfield)
+            writer.write(struct.pack(">IB", 1, 1))
+
+            while True:
+                (length,) = struct.unpack(">I", await reader.readexactly(4))
+                if length == 0:
+                    continue
+
+                message = await reader.readexactly(length)
+                if message[0] != 6:
+                    continue
+
+                (index, begin, block_length) = struct.unpack_from(">III", message, 1)
+                offset = index * self.piece_length + begin
+                frame = struct.pack(">IBII", 9 + block_length, 7, index, begin) + self.data[offset:offset + block_length]
+
+                # the block leaves once the link has sent everything before it, and arrives latency later
+                now = loop.time()
+                if self.bandwidth:
+                    link_free = max(link_free, now) + len(frame) / self.bandwidth
+                    send_at = link_free + self.latency
+                else:
+                    send_at = now + self.latency
+
+                if send_at > now:
+                    loop.call_at(send_at, self.send, writer, frame)
+                else:
+                    writer.write(frame)
+                    await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def send(self, writer, frame):
+        if not writer.is_closing():
+            writer.write(frame)
+
+## random data and a metafile for it, single file or split into num_files
+def make_torrent(directory, size, piece_length, num_files, announce):
+    data = os.urandom(size)
+    pieces = b"".join(hashlib.sha1(data[i:i + piece_length]).digest() for i in range(0, size, piece_length))
+
+    info = {"name": "bench", "piece length": piece_length, "pieces": pieces}
+    if num_files > 1:
+        lengths = [size // num_files] * num_files
+        lengths[-1] += size - sum(lengths)
+        info["files"] = [{"length": length, "path": [f"file{i}.bin"]} for (i, length) in enumerate(lengths)]
+    else:
+        info["length"] = size
+
+    path = os.path.join(directory, "bench.torrent")
+    with open(path, "wb") as f:
+        f.write(bencode.encode({"announce": announce, "info": info}))
+
+    return (path, data, hashlib.sha1(bencode.encode(info)).digest())
+
+## the downloaded data, all files concatenated
+def read_download(directory, num_files):
+    if num_files <= 1:
+        with open(os.path.join(directory, "bench"), "rb") as f:
+            return f.read()
+
+    chunks = []
+    for i in range(num_files):
+        with open(os.path.join(directory, "bench", f"file{i}.bin"), "rb") as f:
+            chunks.append(f.read())
+
+    return b"".join(chunks)
+
+## run the client once, returns (seconds, cpu seconds, peak rss in KB) or None if it failed
+async def run_client(torrent_path, directory, port, client_args):
+    loop = asyncio.get_running_loop()
+
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, os.path.abspath(MAIN), "--port", str(port), *client_args, torrent_path],
+                               cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    # wait4 gives the usage of this one process, RUSAGE_CHILDREN would mix in earlier runs
+    try:
+        (_, status, usage) = await asyncio.wait_for(loop.run_in_executor(None, os.wait4, process.pid, 0), RUN_TIMEOUT)
+    except asyncio.TimeoutError:
+        process.kill()
+        print("  client timed out")
+        return None
+    finally:
+        stderr = process.stderr.read()
+        process.stderr.close()
+
+    elapsed = time.perf_counter() - start
+
+    code = os.waitstatus_to_exitcode(status)
+    if code != 0:
+        print(f"  client failed with {code}: {stderr.decode(errors='replace').strip()}")
+        return None
+
+    return (elapsed, usage.ru_utime + usage.ru_stime, usage.ru_maxrss)
+
+## start main.py --seed instances on a copy of the data each
+async def start_client_seeders(count, torrent_path, data, num_files, directory, bandwidth):
+    processes = []
+    ports = []
+
+    for i in range(count):
+        seed_dir = os.path.join(directory, f"seeder{i}")
+        os.makedirs(seed_dir)
+
+        if num_files <= 1:
+            with open(os.path.join(seed_dir, "bench"), "wb") as f:
+                f.write(data)
+        else:
+            os.makedirs(os.path.join(seed_dir, "bench"))
+            offset = 0
+            size = len(data) // num_files
+            for j in range(num_files):
+                length = size if j < num_files - 1 else len(data) - offset
+                with open(os.path.join(seed_dir, "bench", f"file{j}.bin"), "wb") as f:
+                    f.write(data[offset:offset + length])
+                offset += length
+
+        port = 20000 + os.getpid() % 10000 + i
+        args = ["--seed", "--port", str(port)]
+        if bandwidth:
+            args += ["--upload-limit", str(int(bandwidth / 1024))]
+
+        processes.append(await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(MAIN), *args, torrent_path,
+                                                              cwd=seed_dir, stdout=asyncio.subprocess.DEVNULL,
+                                                              stderr=asyncio.subprocess.DEVNULL))
+        ports.append(port)
+
+    return (processes, ports)
+
+async def benchmark(args):
+    size = int(args.size * 1e6)
+    bandwidth = args.bandwidth * 1e6
+    client_args = shlex.split(args.client_args)
+
+    tracker = LocalTracker(interval=1800)
+    tracker_port = await tracker.start()
+
+    with tempfile.TemporaryDirectory(prefix="bitpour-bench-") as directory:
+        (torrent_path, data, info_hash) = make_torrent(directory, size, args.piece_length * 1024, args.files,
+                                                       f"http://127.0.0.1:{tracker_port}/announce")
+
+        processes = []
+        seeders = []
+        if args.seeder_mode == "client":
+            (processes, ports) = await start_client_seeders(args.seeders, torrent_path, data, args.files,
+                                                            directory, bandwidth)
+            # let them check their data and start listening
+            await asyncio.sleep(2)
+        else:
+            seeders = [Seeder(data, args.piece_length * 1024, info_hash, args.latency / 1000, bandwidth)
+                       for _ in range(args.seeders)]
+            ports = [await seeder.start() for seeder in seeders]
+
+        tracker.peers = [("127.0.0.1", port) for port in ports]
+
+        shaping = f"{args.bandwidth:g} MB/s per seeder" if bandwidth else "unshaped"
+        print(f"{args.size:g} MB in {args.piece_length} KiB pieces, {args.files} file(s), {args.seeders} "
+              f"{args.seeder_mode} seeder(s), latency {args.latency:g} ms, {shaping}")
+
+        results = []
+        try:
+            for run in range(args.runs):
+                client_dir = os.path.join(directory, f"client{run}")
+                os.makedirs(client_dir)
+
+                result = await run_client(torrent_path, client_dir, args.port, client_args)
+                if result is None:
+                    continue
+
+                if read_download(client_dir, args.files) != data:
+                    print(f"  run {run + 1}: downloaded data doesn't match")
+                    continue
+
+                (elapsed, cpu, rss) = result
+                results.append(result)
+                print(f"  run {run + 1}: {elapsed:6.2f} s  {args.size / elapsed:8.1f} MB/s  "
+                      f"{cpu / args.size * 1000:6.1f} ms CPU/MB  {rss / 1024:6.1f} MB peak RSS")
+
+                shutil.rmtree(client_dir)
+        finally:
+            for seeder in seeders:
+                seeder.close()
+
+            for process in processes:
+                process.terminate()
+                await process.wait()
+
+            tracker.close()
+
+    if not results:
+        sys.exit("no successful runs")
+
+    elapsed = statistics.median(result[0] for result in results)
+    cpu = statistics.median(result[1] for result in results)
+    rss = max(result[2] for result in results)
+
+    print(f"median: {elapsed:.2f} s  {args.size / elapsed:.1f} MB/s  {cpu / args.size * 1000:.1f} ms CPU/MB  "
+          f"{rss / 1024:.1f} MB peak RSS")
+
+def main():
+    parser = argparse.ArgumentParser(description="Download benchmark against a loopback swarm")
+    parser.add_argument("--size", type=float, default=100, help="torrent size in MB")
+    parser.add_argument("--piece-length", type=int, default=256, help="piece length in KiB")
+    parser.add_argument("--files", type=int, default=1, help="number of files in the torrent")
+    parser.add_argument("--seeders", type=int, default=4, help="number of seeders")
+    parser.add_argument("--seeder-mode", choices=("inprocess", "client"), default="inprocess",
+                        help="shaped seeders in this process, or main.py --seed subprocesses")
+    parser.add_argument("--latency", type=float, default=0, help="latency added to every block in ms")
+    parser.add_argument("--bandwidth", type=float, default=0, help="upload bandwidth per seeder in MB/s (default: unshaped)")
+    parser.add_argument("--runs", type=int, default=3, help="number of downloads to time")
+    parser.add_argument("--port", type=int, default=18881, help="port the client listens on")
+    parser.add_argument("--client-args", default="", help="extra arguments for main.py, e.g. \"--max-requests 500\"")
+    args = parser.parse_args()
+
+    asyncio.run(benchmark(args))
+
+if __name__ == "__main__":
+    main()
@@ -1,135 +1,181 @@
-# functions to deocde a BEncoded string to a python object
-# also an exception
+# functions to decode a BEncoded string to a python object and encode one back
+# the decoder walks the data once by index, finding delimiters with bytes.index
+# the encoder collects the pieces in a list and joins them once at the end
+# also exceptions
 
 class BEncodeDecodeError(Exception):
     pass
 
-## tokenize raw bencode bytestring
-def tokenize_bencode(bencode):
-    index = 0
-    number = ""
-    while index < len(bencode):
-        # d, l, i
-        # return the character as a bytestring
-        if bencode[index] in [100, 108, 105]:
-            yield bytes(chr(bencode[index]), "utf8")
-
-        # 0, 1, 2, 3, 4, 5, 6, 7, 8, 9, -
-        # store the number in a string to be decoded
-        elif (48 <= bencode[index] <= 57) or bencode[index] == 45:
-            number += chr(bencode[index])
-
-        # :
-        # colon means number has the length of the bytestring 
-        # return the bytestring between "s" and "e" tokens for future ease
-        elif bencode[index] == 58:
-            index += 1
-            byte_string_length = int(number)
-            byte_string =  bencode[(index):(byte_string_length + index)]
-
-            index += byte_string_length - 1
-            number = ""
-
-            yield b"s"
-            yield byte_string
-            yield b"e"
-
-        # e
-        # if number has any value in it, it must be of an int
-        # return the number and the e token
-        elif bencode[index] == 101:
-            if number:
-                yield bytes(number, "utf8")
-                number = ""
-
-            yield b"e"
-
-        # there are no other valid tokens. quit with an error.
-        else:
-            raise BEncodeDecodeError("Invalid BEncode")
+class BEncodeEncodeError(Exception):
+    pass
 
-        index += 1
+## decode a bytestring, which is returned as str if it is valid utf8
+def decode_string(data, index):
+    (raw, index) = decode_raw_string(data, index)
+
+    # It may not be able to be parsed as a string - as in the hashes of the pieces
+    try:
+        return (raw.decode(), index)
+    except UnicodeDecodeError:
+        return (raw, index)
+
+## decode a bytestring starting at index, returning the raw bytes and the index after it
+def decode_raw_string(data, index):
+    colon = data.index(b":", index)
+    length = data[index:colon]
+
+    # the length is plain digits without leading zeros
+    if not length.isdigit() or (length[0] == 48 and len(length) > 1):
+        raise BEncodeDecodeError(f"Invalid BEncode - bad string length at {index}")
+
+    start = colon + 1
+    end = start + int(length)
+    if end > len(data):
+        raise BEncodeDecodeError(f"Invalid BEncode - string at {index} runs past the end")
+
+    return (data[start:end], end)
+
+## decode an int starting at the i at index
+def decode_int(data, index):
+    end = data.index(b"e", index)
+    number = data[index + 1:end]
+
+    # no leading zeros, and no negative zero
+    digits = number[1:] if number[:1] == b"-" else number
+    if not digits.isdigit() or (digits[0] == 48 and len(number) > 1):
+        raise BEncodeDecodeError(f"Invalid BEncode - bad int at {index}")
+
+    return (int(number), end + 1)
 
-## parse bencode tokens into an object
-def parse_token(token, gen):
-    
-    # parse int
-    if token == b'i':
-        number = int(next(gen))
-        if next(gen) != b"e":
-            raise BEncodeDecodeError("Invalid BEncode")
-
-        return number
-
-    # parse string - why the s token was added earlier
-    elif token == b's':
-        string = next(gen)
-        if next(gen) != b"e":
-            raise BEncodeDecodeError("this shouldn't be possible unless the tokenize function has been messed with :P")
-
-        # It may not be able to be parsed as a string - as in the hashes of the pieces
-        try:
-            return string.decode()
-        except UnicodeDecodeError:
-            return string
-
-    # parse list via recursively calling parse_token
-    elif token == b'l':
+## decode the object starting at index, returning it and the index after it
+## if spans is a dict, the (start, end) of each value of this dict is stored in it by key
+def decode_object(data, index, spans=None):
+    kind = data[index]
+
+    # 0-9 - a bytestring
+    if 48 <= kind <= 57:
+        return decode_string(data, index)
+
+    # i
+    elif kind == 105:
+        return decode_int(data, index)
+
+    # l
+    elif kind == 108:
         array = []
-        while (next_token := next(gen)) != b"e":
-            array.append(parse_token(next_token, gen))
+        index += 1
+        while data[index] != 101:
+            (item, index) = decode_object(data, index)
+            array.append(item)
 
-        return array
+        return (array, index + 1)
 
-     # parse dict via recursively calling parse_token
-    elif token == b'd':
-        items = []
-        while (next_token := next(gen)) != b"e":
-            items.append(parse_token(next_token, gen))
-        
-        return dict(zip(items[0::2], items[1::2]))
+    # d - keys are bytestrings in strictly increasing order
+    elif kind == 100:
+        items = {}
+        last_key = None
+        index += 1
+        while data[index] != 101:
+            if not 48 <= data[index] <= 57:
+                raise BEncodeDecodeError(f"Invalid BEncode - dict key at {index} is not a string")
 
-## encode an object into a bencode bytestring
-def encode(obj):
+            (raw_key, index) = decode_raw_string(data, index)
+            if last_key is not None and raw_key <= last_key:
+                raise BEncodeDecodeError(f"Invalid BEncode - dict key {raw_key!r} is out of order")
+            last_key = raw_key
+
+            try:
+                key = raw_key.decode()
+            except UnicodeDecodeError:
+                key = raw_key
 
-    # parse dict by recursively encoding keys and values
+            start = index
+            (items[key], index) = decode_object(data, index)
+
+            if spans is not None:
+                spans[key] = (start, index)
+
+        return (items, index + 1)
+
+    # there are no other valid types. quit with an error.
+    raise BEncodeDecodeError(f"Invalid BEncode - unexpected {chr(kind)!r} at {index}")
+
+## append the bencoding of obj to parts
+def encode_object(obj, parts):
+
+    # parse dict by recursively encoding values, keys go out sorted as raw bytestrings
     if isinstance(obj, dict):
-        bencode = b"d"
+        items = []
         for (key, value) in obj.items():
-            bencode += encode(key)
-            bencode += encode(value)
-        bencode += b"e"
+            if isinstance(key, str):
+                key = key.encode()
+            elif not isinstance(key, bytes):
+                raise BEncodeEncodeError(f"dict key {key!r} is not a string")
 
-        return bencode
+            items.append((key, value))
 
-    # parse list by recursively encoding keys and values
-    elif isinstance(obj, list):
-        bencode = "l"
-        for item in obj:
-            bencode += encode(item)
-        bencode += "e"
+        items.sort(key=lambda item: item[0])
 
-        return bencode
+        parts.append(b"d")
+        for (key, value) in items:
+            parts.append(b"%d:" % len(key))
+            parts.append(key)
+            encode_object(value, parts)
+        parts.append(b"e")
 
-    # concatenate length and bytes - bytestrings usually for pieces hash blob
-    elif isinstance(obj, bytes):
-        bencode = bytes(str(len(obj)) + ":", "utf8")
-        bencode += obj
-        return bencode
+    # parse list by recursively encoding items
+    elif isinstance(obj, (list, tuple)):
+        parts.append(b"l")
+        for item in obj:
+            encode_object(item, parts)
+        parts.append(b"e")
 
-    # concatenate length and str
+    # length and bytes - bytestrings usually for pieces hash blob
+    elif isinstance(obj, (bytes, bytearray, memoryview)):
+        parts.append(b"%d:" % len(obj))
+        parts.append(obj)
+
+    # length and utf8 bytes of the str
     elif isinstance(obj, str):
-        bencode = bytes(str(len(obj)) + ":" + obj, "utf8")
-        return bencode
+        raw = obj.encode()
+        parts.append(b"%d:" % len(raw))
+        parts.append(raw)
 
     elif isinstance(obj, int):
-        return bytes("i" + str(obj) + "e", "utf8")
+        parts.append(b"i%de" % obj)
+
+    else:
+        raise BEncodeEncodeError(f"can't encode {type(obj).__name__}")
+
+## encode an object into a bencode bytestring
+def encode(obj):
+    parts = []
+    encode_object(obj, parts)
+
+    return b"".join(parts)
 
 ## take a raw bencode string and return a python object
-def decode(bencode):
-    tokens = tokenize_bencode(bencode)
-    obj = parse_token(next(tokens), tokens)
-    for _ in tokens:
-        raise BEncodeDecodeError("Invalid Bencode - trailing tokens")
+## with raw set to the name of a top level key, (object, original bytes of that key's value) is returned instead,
+## the bytes being None if the key is missing
+def decode(bencode, raw=None):
+    data = bytes(bencode)
+    spans = {} if raw is not None else None
+
+    try:
+        (obj, index) = decode_object(data, 0, spans)
+
+    # ran off the end looking for a delimiter or closing e
+    except (IndexError, ValueError):
+        raise BEncodeDecodeError("Invalid BEncode - unexpected end of data")
+
+    except RecursionError:
+        raise BEncodeDecodeError("Invalid BEncode - nested too deeply")
+
+    if index != len(data):
+        raise BEncodeDecodeError("Invalid Bencode - trailing data")
+
+    if raw is not None:
+        span = spans.get(raw)
+        return (obj, data[span[0]:span[1]] if span is not None else None)
 
-    return obj
\ No newline at end of file
+    return obj
@@ -0,0 +1,148 @@
+from random import randrange
+
+# Every byte value with its bits in reverse order. The wire format puts
+# piece 0 in the high bit of the first byte, we keep it in the low bit.
+_REVERSED = bytes(int(f"{byte:08b}"[::-1], 2) for byte in range(256))
+
+# int.bit_count is only there from 3.10 on
+if hasattr(int, "bit_count"):
+    _popcount = int.bit_count
+else:
+    def _popcount(bits):
+        return bin(bits).count("1")
+
+# A set of piece indices stored as the bits of a single int, piece i being
+# bit i. Whole bitfields are combined with & | and - (and not) and counted
+# in one int operation each, so questions like "which pieces does this peer
+# have that we still need" don't loop over pieces in Python. A Bitfield()
+# is empty, which is what a peer that sent no bitfield has.
+#
+# Testing or changing a single bit of the int costs a pass over all of it,
+# so long-lived bitfields - the ones parsed, built from indices or grown
+# from empty - also keep the same bits in a byte array, piece i in bit
+# i & 7 of byte i >> 3, which answers "in" directly. The results of & | and
+# - don't build one, they are mostly short-lived and often small.
+class Bitfield:
+    __slots__ = ("bits", "_bytes")
+
+    def __init__(self, bits=0, data=None):
+        self.bits = bits
+
+        # the byte array, or None to test bits on the int
+        if data is None and bits == 0:
+            data = bytearray()
+
+        self._bytes = data
+
+    ## parse the wire format, bits past num_pieces are dropped
+    @classmethod
+    def from_bytes(cls, data, num_pieces):
+        data = bytearray(bytes(data[:(num_pieces + 7) >> 3]).translate(_REVERSED))
+        if num_pieces & 7 and len(data) == (num_pieces + 7) >> 3:
+            data[-1] &= (1 << (num_pieces & 7)) - 1
+
+        return cls(int.from_bytes(data, "little"), data)
+
+    ## every piece
+    @classmethod
+    def full(cls, num_pieces):
+        bits = (1 << num_pieces) - 1
+        return cls(bits, bytearray(bits.to_bytes((num_pieces + 7) >> 3, "little")))
+
+    @classmethod
+    def from_indices(cls, indices):
+        indices = list(indices)
+        if not indices:
+            return cls()
+
+        buf = bytearray((max(indices) >> 3) + 1)
+        for index in indices:
+            buf[index >> 3] |= 1 << (index & 7)
+
+        return cls(int.from_bytes(buf, "little"), buf)
+
+    ## the wire format, num_pieces bits rounded up to whole bytes
+    def to_bytes(self, num_pieces):
+        return self.bits.to_bytes((num_pieces + 7) >> 3, "little").translate(_REVERSED)
+
+    def add(self, index):
+        self.bits |= 1 << index
+
+        data = self._bytes
+        if data is not None:
+            if index >> 3 >= len(data):
+                data.extend(bytes((index >> 3) + 1 - len(data)))
+
+            data[index >> 3] |= 1 << (index & 7)
+
+    def discard(self, index):
+        if index not in self:
+            return
+
+        self.bits ^= 1 << index
+        if self._bytes is not None:
+            self._bytes[index >> 3] &= ~(1 << (index & 7))
+
+    def copy(self):
+        return Bitfield(self.bits, None if self._bytes is None else bytearray(self._bytes))
+
+    ## the first set bit at or after start, or None
+    def next_set(self, start=0):
+        bits = self.bits >> start
+        if not bits:
+            return None
+
+        return start + (bits & -bits).bit_length() - 1
+
+    ## a set bit chosen by scanning from a random point in [0, limit), or None
+    def random_set(self, limit):
+        if not self.bits:
+            return None
+
+        index = self.next_set(randrange(limit)) if limit > 0 else None
+        if index is None:
+            index = self.next_set()
+
+        return index
+
+    def __contains__(self, index):
+        data = self._bytes
+        if data is None:
+            return (self.bits >> index) & 1 == 1
+
+        return index >> 3 < len(data) and (data[index >> 3] >> (index & 7)) & 1 == 1
+
+    def __iter__(self):
+        data = self._bytes
+        if data is None:
+            data = self.bits.to_bytes((self.bits.bit_length() + 7) >> 3, "little")
+
+        for (byte_index, byte) in enumerate(data):
+            if not byte:
+                continue
+
+            for bit in range(8):
+                if byte & (1 << bit):
+                    yield (byte_index << 3) + bit
+
+    ## number of set bits
+    def __len__(self):
+        return _popcount(self.bits)
+
+    def __bool__(self):
+        return self.bits != 0
+
+    def __and__(self, other):
+        return Bitfield(self.bits & other.bits)
+
+    def __or__(self, other):
+        return Bitfield(self.bits | other.bits)
+
+    def __sub__(self, other):
+        return Bitfield(self.bits & ~other.bits)
+
+    def __eq__(self, other):
+        return isinstance(other, Bitfield) and self.bits == other.bits
+
+    def __repr__(self):
+        return f"Bitfield({list(self)})"
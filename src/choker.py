@@ -0,0 +1,72 @@
+import asyncio
+import random
+
+# Number of peers we upload to at once, one of them is the optimistic unchoke
+UPLOAD_SLOTS = 4
+
+# Seconds between re-evaluating who gets an upload slot
+UNCHOKE_INTERVAL = 10
+
+# Seconds between rotating the optimistic unchoke
+OPTIMISTIC_INTERVAL = 30
+
+# A class that hands out upload slots tit-for-tat: every round the peers
+# that give us the best download rates (or that we upload to the fastest,
+# once we are seeding) get unchoked, plus one optimistic unchoke picked at
+# random so new peers get a chance to prove themselves.
+class Choker:
+    def __init__(self, workers, picker, slots=UPLOAD_SLOTS):
+        # callable returning the current workers
+        self.workers = workers
+        self.picker = picker
+        self.slots = max(slots, 1)
+
+        self.optimistic = None
+
+    async def run(self):
+        rounds = 0
+        rounds_per_optimistic = max(OPTIMISTIC_INTERVAL // UNCHOKE_INTERVAL, 1)
+
+        while True:
+            self.rechoke(rounds % rounds_per_optimistic == 0)
+            rounds += 1
+
+            await asyncio.sleep(UNCHOKE_INTERVAL)
+
+    ## how much a peer deserves a slot
+    def score(self, peer_worker):
+        # seeding, there is nothing to reciprocate - favour peers that can take data the fastest
+        if self.picker.is_finished():
+            return peer_worker.upload_rate.rate()
+
+        return peer_worker.download_rate.rate()
+
+    def rechoke(self, rotate_optimistic):
+        workers = [peer_worker for peer_worker in self.workers() if peer_worker.is_connected()]
+        interested = [peer_worker for peer_worker in workers if peer_worker.peer.peer_interested]
+
+        interested.sort(key=self.score, reverse=True)
+        unchoked = set(interested[:self.slots - 1])
+
+        if rotate_optimistic or self.optimistic not in interested or self.optimistic in unchoked:
+            candidates = [peer_worker for peer_worker in interested if peer_worker not in unchoked]
+            self.optimistic = random.choice(candidates) if candidates else None
+
+        if self.optimistic is not None:
+            unchoked.add(self.optimistic)
+
+        for peer_worker in workers:
+            if peer_worker in unchoked:
+                if peer_worker.peer.client_choking:
+                    peer_worker.unchoke()
+            elif not peer_worker.peer.client_choking:
+                peer_worker.choke()
+
+    ## a peer became interested - give it a slot right away if one is free
+    def peer_interested(self, peer_worker):
+        if not peer_worker.peer.client_choking:
+            return
+
+        unchoked = sum(1 for other in self.workers() if other.is_connected() and not other.peer.client_choking)
+        if unchoked < self.slots:
+            peer_worker.unchoke()
@@ -0,0 +1,180 @@
+import os
+import bisect
+import threading
+import collections
+
+# Max number of data files kept open at once
+MAX_OPEN_FILES = 64
+
+# The data files of a torrent as one contiguous range of bytes.
+# A sorted index of file start offsets maps a torrent offset to the file
+# holding it with bisect, and descriptors are opened on demand and kept in a
+# bounded LRU so torrents with huge numbers of files never run out of them.
+# I/O is done with pread/pwrite under a lock, which is only held for the
+# single call so the writer thread and the upload reads can share the files.
+class DataFiles:
+    def __init__(self, torrent, writable=True, max_open=MAX_OPEN_FILES):
+        self.files = torrent.files
+        self.writable = writable
+        self.max_open = max(max_open, 1)
+
+        # start offsets of the non empty files, and which file each one is
+        self.starts = []
+        self.indices = []
+        for (index, f) in enumerate(self.files):
+            if f.length > 0:
+                self.starts.append(f.offset)
+                self.indices.append(index)
+
+        # file index : descriptor, least recently used first
+        self.open_files = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+        # a read still running in a thread when we close must not open the files again
+        self.closed = False
+
+    ## whether there was data on disk before us that may hold valid pieces
+    def existing(self):
+        for f in self.files:
+            try:
+                if os.stat(f.path).st_size > 0:
+                    return True
+            except OSError:
+                pass
+
+        return False
+
+    ## (total size, latest modification) of the files on disk, missing files count as empty
+    def stat(self):
+        size = 0
+        mtime = 0
+        for f in self.files:
+            try:
+                st = os.stat(f.path)
+            except OSError:
+                continue
+
+            size += st.st_size
+            mtime = max(mtime, st.st_mtime_ns)
+
+        return (size, mtime)
+
+    ## create empty files up front, nothing is ever written to them
+    def create_empty(self):
+        for f in self.files:
+            if f.length == 0 and not os.path.exists(f.path):
+                self.make_dirs(f.path)
+                os.close(os.open(f.path, os.O_WRONLY | os.O_CREAT, 0o644))
+
+    def make_dirs(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    ## (file index, offset in the file, length) for each file the range covers
+    def spans(self, offset, length):
+        position = bisect.bisect_right(self.starts, offset) - 1
+
+        while length > 0 and position < len(self.starts):
+            f = self.files[self.indices[position]]
+            file_offset = offset - f.offset
+            span = min(length, f.length - file_offset)
+
+            yield (self.indices[position], file_offset, span)
+
+            offset += span
+            length -= span
+            position += 1
+
+    ## descriptor of a file, opening it (and closing the least recently used one) if needed
+    ## must be called with the lock held
+    def fd(self, index):
+        fd = self.open_files.get(index)
+        if fd is not None:
+            self.open_files.move_to_end(index)
+            return fd
+
+        if len(self.open_files) >= self.max_open:
+            (_, oldest) = self.open_files.popitem(last=False)
+            os.close(oldest)
+
+        f = self.files[index]
+        if self.writable:
+            self.make_dirs(f.path)
+            fd = os.open(f.path, os.O_RDWR | os.O_CREAT, 0o644)
+
+            try:
+                self.preallocate(fd, f.length)
+            except OSError:
+                os.close(fd)
+                raise
+        else:
+            fd = os.open(f.path, os.O_RDONLY)
+
+        self.open_files[index] = fd
+        return fd
+
+    ## reserve the whole file the first time it is opened so pieces can be written at any offset
+    def preallocate(self, fd, length):
+        if os.fstat(fd).st_size == length:
+            return
+
+        os.ftruncate(fd, length)
+
+        # actually reserve the blocks where supported, otherwise the file is sparse
+        if hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(fd, 0, length)
+            except OSError:
+                pass
+
+    ## write data at a torrent offset, handling short writes and files it straddles
+    def write(self, offset, data):
+        view = memoryview(data)
+
+        for (index, file_offset, length) in self.spans(offset, len(view)):
+            chunk = view[:length]
+            view = view[length:]
+
+            with self.lock:
+                fd = self.fd(index)
+                while chunk:
+                    written = os.pwrite(fd, chunk, file_offset)
+                    chunk = chunk[written:]
+                    file_offset += written
+
+    ## read length bytes at a torrent offset, shorter if files are missing or short
+    def read(self, offset, length):
+        chunks = []
+
+        for (index, file_offset, span) in self.spans(offset, length):
+            with self.lock:
+                if self.closed:
+                    break
+
+                try:
+                    chunk = os.pread(self.fd(index), span, file_offset)
+                except FileNotFoundError:
+                    break
+
+            chunks.append(chunk)
+            if len(chunk) < span:
+                break
+
+        if len(chunks) == 1:
+            return chunks[0]
+
+        return b"".join(chunks)
+
+    def sync(self):
+        with self.lock:
+            for fd in self.open_files.values():
+                os.fsync(fd)
+
+    def close(self):
+        with self.lock:
+            for fd in self.open_files.values():
+                os.close(fd)
+
+            self.open_files.clear()
+            self.closed = True
@@ -0,0 +1,90 @@
+import os
+import asyncio
+from hashlib import sha1
+from concurrent.futures import ThreadPoolExecutor
+
+# A class that verifies downloaded pieces on a bounded pool of threads
+# so hashing never stalls the event loop
+class Hasher:
+    def __init__(self, workers=None, incremental=False):
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="hasher")
+
+        # hash blocks in the pool as they arrive while they are contiguous, instead of all at once at the end
+        self.incremental = incremental
+
+    ## start hashing a new piece
+    def piece(self, piece_hash, length):
+        return PieceHash(piece_hash, length, self.pool if self.incremental else None)
+
+    ## finish hashing a piece in the pool, returns True if it matches
+    async def verify(self, piece_hash, piece_buf):
+        loop = asyncio.get_running_loop()
+
+        # the prefix still being hashed, and whatever arrived behind it meanwhile
+        while piece_hash.job is not None:
+            await asyncio.wait({piece_hash.job})
+
+        # hash straight out of the piece buffer, no copy
+        with memoryview(piece_buf) as view:
+            return await loop.run_in_executor(self.pool, piece_hash.finish, view)
+
+    def close(self):
+        self.pool.shutdown(wait=False)
+
+# The running hash of a single piece. With a pool, the contiguous prefix
+# of received blocks is fed to sha there, one job at a time so the updates
+# stay in order; without one everything is hashed by finish.
+class PieceHash:
+    def __init__(self, piece_hash, length, pool=None):
+        self.expected = piece_hash
+        self.length = length
+        self.pool = pool
+
+        self.sha = sha1()
+
+        # length of the contiguous prefix already fed to sha
+        self.hashed = 0
+
+        # blocks that arrived ahead of the prefix - begin : length
+        self.pending = {}
+
+        # the pool future hashing the next part of the prefix, if one is running
+        self.job = None
+
+    ## record a block landing in the piece buffer, hashing it in the pool if it extends the prefix
+    def block_received(self, piece_buf, begin, length):
+        if self.pool is None:
+            return
+
+        self.pending[begin] = length
+
+        if self.job is None:
+            self.submit(piece_buf)
+
+    ## hand the blocks that extend the prefix to the pool as one update
+    def submit(self, piece_buf):
+        end = self.hashed
+        while end in self.pending:
+            end += self.pending.pop(end)
+
+        if end == self.hashed:
+            return
+
+        view = memoryview(piece_buf)[self.hashed:end]
+        self.job = asyncio.get_running_loop().run_in_executor(self.pool, self.sha.update, view)
+
+        def done(job):
+            view.release()
+            self.hashed = end
+            self.job = None
+
+            # blocks that arrived while this part was hashed
+            self.submit(piece_buf)
+
+        self.job.add_done_callback(done)
+
+    ## hash whatever is left and compare
+    def finish(self, view):
+        self.sha.update(view[self.hashed:self.length])
+        return self.sha.digest() == self.expected
@@ -1,18 +1,24 @@
 #!/usr/bin/env python3.8
+import os
 import sys
 import asyncio
+import argparse
 import socket
 
 from random import randint
 from enum import Enum
 
 from bencode import BEncodeDecodeError
-from urllib.request import URLError
 
-from torrent import Torrent
-from tracker import Tracker, TrackerParseError
-from peer import Peer
-from worker import Worker
+from torrent import Torrent, TorrentParseError
+from resume import Resume
+from hasher import Hasher
+import worker
+from session import Session
+import choker
+from ratelimit import RateLimits
+from metrics import Metrics
+import manager
 
 # Peer ID that identifies the client.
 ID = bytes('-BU0000-' + ''.join([chr(randint(0, 255)) for _ in range(12)]), "latin1")
@@ -25,16 +31,51 @@ def error_quit(error):
     sys.stderr.write("Error: " + error + "\n")
     sys.exit(1)
 
-def main():
-    # make sure a file name is provided
-    if len(sys.argv) < 2:
-        error_quit("File name not provided")
-
-
-    ## attempt to decode torrent
-    torrent = None
+## parse command line arguments
+def parse_args():
+    parser = argparse.ArgumentParser(description="bitTorrent client")
+    parser.add_argument("torrents", nargs="+", metavar="torrent", help="path to a .torrent file")
+    parser.add_argument("--port", type=int, default=PORT,
+                        help="port to listen for incoming peers on")
+    parser.add_argument("--seed", action="store_true",
+                        help="keep uploading to peers after the download finishes")
+    parser.add_argument("--upload-slots", type=int, default=choker.UPLOAD_SLOTS,
+                        help="number of peers to upload to at once, including the optimistic unchoke")
+    parser.add_argument("--download-limit", type=int, default=0,
+                        help="total download rate limit in KiB/s (default: unlimited)")
+    parser.add_argument("--upload-limit", type=int, default=0,
+                        help="total upload rate limit in KiB/s (default: unlimited)")
+    parser.add_argument("--peer-download-limit", type=int, default=0,
+                        help="download rate limit per peer in KiB/s (default: unlimited)")
+    parser.add_argument("--peer-upload-limit", type=int, default=0,
+                        help="upload rate limit per peer in KiB/s (default: unlimited)")
+    parser.add_argument("--recheck", action="store_true",
+                        help="hash existing data against the torrent, write the resume file and exit")
+    parser.add_argument("--hash-threads", type=int, default=None,
+                        help="number of threads used to hash pieces (default: number of CPUs)")
+    parser.add_argument("--incremental-hash", action="store_true",
+                        help="hash blocks as they arrive in order instead of whole pieces at the end")
+    parser.add_argument("--min-requests", type=int, default=worker.MIN_REQUESTS,
+                        help="minimum number of block requests kept in flight per peer")
+    parser.add_argument("--max-requests", type=int, default=worker.MAX_REQUESTS,
+                        help="maximum number of block requests kept in flight per peer")
+    parser.add_argument("--max-connections", type=int, default=manager.MAX_CONNECTIONS,
+                        help="maximum number of peers to be connected to at once")
+    parser.add_argument("--max-half-open", type=int, default=manager.MAX_HALF_OPEN,
+                        help="maximum number of connection attempts in flight at once")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve metrics in the Prometheus text format on 127.0.0.1 at this port")
+    parser.add_argument("--metrics-socket", default=None,
+                        help="serve metrics in the Prometheus text format on this unix socket")
+    parser.add_argument("--stats-interval", type=float, default=5,
+                        help="seconds between summary lines, 0 to turn them off")
+
+    return parser.parse_args()
+
+## load a torrent file, quitting with an error if it can't be used
+def load_torrent(path):
     try:
-        torrent = Torrent(sys.argv[1])
+        return Torrent(path)
 
     except OSError as e:
         error_quit(f"Could not open torrent file - {e}")
@@ -42,81 +83,82 @@ def main():
     except BEncodeDecodeError as e:
         error_quit(f"Could not decode torrent file - {e}")
 
-    except Exception as e:
-        error_quit(f"Unexpected error! - {e}")
-        
-
-
-    ## attempt to contact tracker
-    tracker = Tracker(torrent, ID, PORT)
-    try:
-        response = tracker.request()
-
-    except TrackerParseError as e:
-        error_quit(f"Tracker Parsing error - {e}")
-
-    except URLError as e:
-        error_quit(f"Could not connect to tracker: {e}")
-
-    except BEncodeDecodeError as e:
-        error_quit(f"Malformed tracker response: {e}")
+    except TorrentParseError as e:
+        error_quit(f"Invalid torrent file - {e}")
 
     except Exception as e:
         error_quit(f"Unexpected error! - {e}")
 
+def main():
+    args = parse_args()
 
+    ## attempt to decode the torrents
+    torrents = [load_torrent(path) for path in args.torrents]
 
-    # make sure the peers blob is correct
-    if len(response["peers"]) % 6 != 0:
-        error_quit("Malformed peers list")
-
-
-    # list of raw peer IPs and port
-    raw_peers = [response["peers"][i:i+6] for i in range(0, len(response["peers"]), 6)]
-
-    # peers we are attempting to request pieces from
-    seed_peers = []
-    for peer_bytes in raw_peers:
-        try:
-            seed_peers.append(Peer(peer_bytes))
-        except ValueError as e:
-            print(f"Could not parse {peer_bytes}'s ip: {e}")
-
-
-    asyncio.run(do_connect(seed_peers, torrent))
+    if args.recheck:
+        for torrent in torrents:
+            do_recheck(torrent, args.hash_threads)
+        return
 
-    
-## async function to connect and download from peers
-async def do_connect(peers, torrent):
-    peer_queue = asyncio.Queue()
-    pieces_queue = asyncio.Queue()
-    downloaded_queue = asyncio.Queue()
+    hasher = Hasher(args.hash_threads, args.incremental_hash)
+    try:
+        ok = asyncio.run(do_session(torrents, hasher, args))
+    finally:
+        hasher.close()
 
-    [peer_queue.put_nowait(peer) for peer in peers]
-    [pieces_queue.put_nowait((index, piece, torrent.get_piece_length(index))) for index, piece in enumerate(torrent.pieces)]
+    if not ok:
+        sys.exit(1)
 
-    handlers = [Worker(f"thread {x}", torrent, ID, peer_queue, pieces_queue, downloaded_queue) for x in range(30)]
     
-    [asyncio.create_task(worker.run()) for worker in handlers]
-    # await asyncio.gather(*[worker.run() for worker in handlers])
-    print("handlers finished")
+## verify existing data on disk in parallel and record the good pieces
+def do_recheck(torrent, hash_threads):
+    if not os.path.exists(torrent.filename):
+        error_quit(f"Nothing to recheck - {torrent.filename} does not exist")
 
-    await pieces_queue.join()
+    resume = Resume(torrent, torrent.filename)
+    recheck = resume.check_existing(torrent, hash_threads)
+    resume.save()
 
-    downloaded_pieces = []
-    for x in range(downloaded_queue.qsize()):
-        downloaded_pieces.append(await downloaded_queue.get())
+    good = len(torrent.pieces) - len(resume.missing_pieces())
+    print(f"{good}/{len(torrent.pieces)} pieces good - "
+          f"checked {recheck.bytes_checked / 1e6:.1f} MB in {recheck.elapsed:.2f}s "
+          f"({recheck.throughput():.1f} MB/s, {recheck.workers} threads)")
 
-    downloaded_pieces.sort(key=sort_index)
+## run every torrent in one session until they are done, or forever when seeding
+## returns False if a torrent failed
+async def do_session(torrents, hasher, args):
+    limits = RateLimits(args.download_limit * 1024, args.upload_limit * 1024,
+                        args.peer_download_limit * 1024, args.peer_upload_limit * 1024)
 
-    with open(torrent.filename, "wb+") as f:
-        for (piece_index, piece) in downloaded_pieces:
-            f.write(piece)
+    session = Session(ID, args.port, hasher, limits, args.max_connections, args.max_half_open,
+                      args.min_requests, args.max_requests, args.upload_slots, args.seed)
+    await session.start()
 
+    metrics = Metrics(session)
+    await metrics.start(args.metrics_port, args.metrics_socket, args.stats_interval)
 
-
-def sort_index(q_item):
-    return q_item[0]
+    try:
+        active = []
+        ok = True
+        for torrent in torrents:
+            try:
+                active.append(await session.add(torrent))
+            except OSError as e:
+                print(f"{torrent.filename}: could not start - {e}")
+                ok = False
+
+        # a torrent that fails has said why already, the others keep going
+        results = await asyncio.gather(*(torrent.wait_finished() for torrent in active))
+        ok = ok and all(results)
+
+        if args.seed:
+            print("Download complete, seeding")
+            await asyncio.Event().wait()
+
+        return ok
+    finally:
+        await metrics.stop()
+        await session.stop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,340 @@
+import asyncio
+import time
+
+from peer import Peer
+from worker import Worker, AsyncConnectionError
+import worker
+
+# Max number of peers we are connected (or connecting) to
+MAX_CONNECTIONS = 50
+
+# Max number of connection attempts in flight at once
+MAX_HALF_OPEN = 8
+
+# Seconds to wait for a connection attempt
+CONNECT_TIMEOUT = 3
+
+# Seconds between launching connection attempts - attempts overlap instead of
+# waiting on each other, so whichever peers answer first get going first
+CONNECT_STAGGER = 0.05
+
+# Seconds before retrying a peer, doubled on every consecutive failure
+RETRY_BACKOFF = 5
+MAX_BACKOFF = 300
+
+# Peers that failed this many times in a row are given up on
+MAX_FAILURES = 6
+
+# Max number of peers we remember, peers we gave up on make room for new ones
+MAX_CANDIDATES = 2000
+
+# Seconds between looking for a slow connection to replace
+SCORE_INTERVAL = 10
+
+# Seconds a connection gets to prove itself before it can be replaced
+MIN_EVICT_AGE = 30
+
+# A peer we know about and may connect to
+class Candidate:
+    def __init__(self, peer):
+        self.peer = peer
+
+        self.failures = 0
+        self.next_attempt = 0.0
+
+        # an attempt or connection to this peer is running
+        self.active = False
+
+        # the last connection was dropped for being too slow
+        self.evicted = False
+
+    def can_connect(self, now):
+        return not self.active and self.failures < MAX_FAILURES and self.next_attempt <= now
+
+    def given_up(self):
+        return not self.active and self.failures >= MAX_FAILURES
+
+    def backoff(self, now):
+        self.failures += 1
+        self.next_attempt = now + min(RETRY_BACKOFF * (1 << (self.failures - 1)), MAX_BACKOFF)
+
+# Connection limits shared by the managers of every torrent in a session
+class ConnectionBudget:
+    def __init__(self, max_connections=MAX_CONNECTIONS, max_half_open=MAX_HALF_OPEN):
+        self.max_connections = max_connections
+        self.max_half_open = max_half_open
+
+        self.managers = set()
+
+    def num_connections(self):
+        return sum(connections.num_connections() for connections in self.managers)
+
+    def is_full(self):
+        return self.num_connections() >= self.max_connections
+
+    def can_connect(self):
+        half_open = sum(connections.half_open for connections in self.managers)
+        return not self.is_full() and half_open < self.max_half_open
+
+    ## a connection or attempt ended, every torrent may use the room
+    def released(self):
+        for connections in self.managers:
+            connections.wakeup.set()
+
+# A class that keeps the torrent connected to as many useful peers as allowed.
+# It launches overlapping connection attempts up to the half-open limit,
+# retries failed peers with exponential backoff and periodically replaces
+# the slowest connection when there are untried peers waiting.
+class ConnectionManager:
+    def __init__(self, torrent, peer_id, scheduler, storage,
+                 max_connections=MAX_CONNECTIONS, max_half_open=MAX_HALF_OPEN,
+                 min_requests=worker.MIN_REQUESTS, max_requests=worker.MAX_REQUESTS, seed=False, limits=None, budget=None):
+        self.torrent = torrent
+        self.peer_id = peer_id
+        self.scheduler = scheduler
+        self.picker = scheduler.picker
+        self.storage = storage
+        self.seed = seed
+        self.limits = limits
+
+        # limits on connections, shared with other torrents when running in a session
+        self.budget = budget or ConnectionBudget(max_connections, max_half_open)
+        self.min_requests = min_requests
+        self.max_requests = max_requests
+
+        # (host, port) : Candidate
+        self.candidates = {}
+
+        # Candidate : Worker for every established connection
+        self.workers = {}
+        self.half_open = 0
+
+        # Workers for peers that connected to us
+        self.incoming = set()
+
+        # hands out upload slots, passed on to every worker
+        self.choker = None
+
+        # called when there is room for connections but no peer left to try
+        self.on_starved = None
+
+        # bytes transferred over connections that have ended
+        self.uploaded = 0
+        self.downloaded = 0
+
+        # connection attempts that failed, and connections dropped for being slow
+        self.connect_failures = 0
+        self.evictions = 0
+
+        self.tasks = set()
+        self.wakeup = asyncio.Event()
+
+        self.budget.managers.add(self)
+
+    def num_connections(self):
+        return len(self.workers) + len(self.incoming) + self.half_open
+
+    def all_workers(self):
+        return list(self.workers.values()) + list(self.incoming)
+
+    ## (uploaded, downloaded) bytes over every connection so far
+    def transferred(self):
+        uploaded = self.uploaded + sum(peer_worker.upload_rate.total for peer_worker in self.all_workers())
+        downloaded = self.downloaded + sum(peer_worker.download_rate.total for peer_worker in self.all_workers())
+
+        return (uploaded, downloaded)
+
+    def connection_ended(self, peer_worker):
+        self.uploaded += peer_worker.upload_rate.total
+        self.downloaded += peer_worker.download_rate.total
+
+        self.budget.released()
+
+    ## add peers to connect to, from the tracker or anywhere else - the same peer is only kept once
+    def add_peers(self, peers):
+        for peer in peers:
+            key = (peer.host, peer.port)
+            candidate = self.candidates.get(key)
+
+            if candidate is None:
+                if len(self.candidates) >= MAX_CANDIDATES and not self.forget_candidate():
+                    continue
+
+                self.candidates[key] = Candidate(peer)
+
+            # we gave up on it but it is still around, give it one more go
+            elif candidate.given_up():
+                candidate.failures = MAX_FAILURES - 1
+                candidate.next_attempt = 0.0
+
+        # new peers for idle slots
+        self.wakeup.set()
+
+    ## drop a peer we gave up on to make room, returns False if there is none
+    def forget_candidate(self):
+        for (key, candidate) in self.candidates.items():
+            if candidate.given_up():
+                del self.candidates[key]
+                return True
+
+        return False
+
+    ## the candidate to try next - the one that failed the least
+    def next_candidate(self, now):
+        best = None
+        for candidate in self.candidates.values():
+            if candidate.can_connect(now) and (best is None or candidate.failures < best.failures):
+                best = candidate
+
+        return best
+
+    ## when the next backed off candidate becomes eligible
+    def next_retry(self, now):
+        retries = [candidate.next_attempt for candidate in self.candidates.values()
+                   if not candidate.active and candidate.failures < MAX_FAILURES and candidate.next_attempt > now]
+
+        return min(retries, default=None)
+
+    async def run(self):
+        last_score = time.monotonic()
+
+        while not self.picker.is_finished():
+            now = time.monotonic()
+
+            if now - last_score >= SCORE_INTERVAL:
+                self.evict_slowest(now)
+                last_score = now
+
+            if self.budget.can_connect():
+                candidate = self.next_candidate(now)
+
+                if candidate is not None:
+                    self.start(candidate)
+                    await asyncio.sleep(CONNECT_STAGGER)
+                    continue
+
+                # room for more connections and nobody left to try, not even later
+                if self.on_starved is not None and self.next_retry(now) is None:
+                    self.on_starved()
+
+            # sleep until an attempt finishes, new peers arrive, a retry is due or it's time to score
+            timeout = last_score + SCORE_INTERVAL - now
+            retry = self.next_retry(now)
+            if retry is not None:
+                timeout = min(timeout, retry - now)
+
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=max(timeout, 0))
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self, candidate):
+        candidate.active = True
+
+        task = asyncio.ensure_future(self.connect(candidate))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    ## connect to a candidate and run a worker on the connection until it ends
+    async def connect(self, candidate):
+        peer_worker = Worker(str(candidate.peer), self.torrent, self.peer_id, candidate.peer, self.scheduler, self.storage,
+                             self.min_requests, self.max_requests, seed=self.seed, choker=self.choker, limits=self.limits)
+
+        self.half_open += 1
+        try:
+            await peer_worker.connect(CONNECT_TIMEOUT)
+        except AsyncConnectionError:
+            self.connect_failures += 1
+            candidate.active = False
+            candidate.backoff(time.monotonic())
+            return
+        finally:
+            self.half_open -= 1
+            self.budget.released()
+
+        self.workers[candidate] = peer_worker
+
+        try:
+            await peer_worker.run()
+        finally:
+            del self.workers[candidate]
+            candidate.active = False
+            self.connection_ended(peer_worker)
+
+            # a peer that gave us data is worth coming back to soon, anything else backs off
+            now = time.monotonic()
+            if candidate.evicted:
+                candidate.evicted = False
+                candidate.next_attempt = now + MAX_BACKOFF
+            elif peer_worker.download_rate.total > 0:
+                candidate.failures = 0
+                candidate.next_attempt = now + RETRY_BACKOFF
+            else:
+                candidate.backoff(now)
+
+    ## a peer connected to us, called by the listening server
+    def accept(self, stream):
+        if self.budget.is_full():
+            stream.transport.close()
+            return
+
+        (host, port) = stream.transport.get_extra_info("peername")[:2]
+        peer = Peer(host, port)
+
+        peer_worker = Worker(str(peer), self.torrent, self.peer_id, peer, self.scheduler, self.storage,
+                             self.min_requests, self.max_requests, incoming=True, seed=self.seed, choker=self.choker, limits=self.limits)
+        peer_worker.stream = stream
+        peer_worker.connected_at = time.monotonic()
+
+        task = asyncio.ensure_future(self.serve_incoming(peer_worker))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def serve_incoming(self, peer_worker):
+        self.incoming.add(peer_worker)
+        try:
+            await peer_worker.run()
+        finally:
+            self.incoming.discard(peer_worker)
+            self.connection_ended(peer_worker)
+
+    ## tell every connected peer about a piece we now have
+    def broadcast_have(self, index):
+        for peer_worker in self.all_workers():
+            peer_worker.send_have(index)
+
+    ## make room for a waiting candidate by dropping the slowest established connection
+    def evict_slowest(self, now):
+        if not self.budget.is_full() or self.next_candidate(now) is None:
+            return
+
+        slowest = None
+        for (candidate, peer_worker) in self.workers.items():
+            if now - peer_worker.connected_at < MIN_EVICT_AGE:
+                continue
+
+            if slowest is None or peer_worker.download_rate.rate() < slowest[1].download_rate.rate():
+                slowest = (candidate, peer_worker)
+
+        if slowest is None:
+            return
+
+        (candidate, peer_worker) = slowest
+
+        self.evictions += 1
+        candidate.evicted = True
+        peer_worker.close()
+
+    ## drop every connection and attempt
+    async def stop(self):
+        self.budget.managers.discard(self)
+
+        for peer_worker in self.all_workers():
+            peer_worker.close()
+
+        tasks = list(self.tasks)
+        for task in tasks:
+            task.cancel()
+
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -1,5 +1,17 @@
 import struct
 
+# Precompiled formats - length prefix and id, and the fixed size messages
+LENGTH = struct.Struct(">I")
+HEADER = struct.Struct(">IB")
+HAVE = struct.Struct(">IBI")
+BLOCK = struct.Struct(">IBIII")
+PIECE_HEADER = struct.Struct(">IBII")
+
+# Payloads past the id byte
+INDEX = struct.Struct(">I")
+BLOCK_PAYLOAD = struct.Struct(">III")
+PIECE_PAYLOAD = struct.Struct(">II")
+
 class MessageParseError(Exception):
     pass
 
@@ -7,6 +19,15 @@ class Message:
     def construct(self):
         pass
 
+    ## bytes on the wire, length prefix included
+    def size(self):
+        return 4 + self.length
+
+    ## write the message into buffer at offset, the buffer must have size() bytes free there
+    def pack_into(self, buffer, offset):
+        frame = self.construct()
+        buffer[offset:offset + len(frame)] = frame
+
     # the raw bytes does not include the length prefix
     @classmethod
     def deconstruct(self, raw_bytes):
@@ -35,7 +56,10 @@ class KeepAlive(Message):
         pass
 
     def construct(self):
-        return struct.pack(">I", self.length)
+        return LENGTH.pack(self.length)
+
+    def pack_into(self, buffer, offset):
+        LENGTH.pack_into(buffer, offset, self.length)
 
     @classmethod
     def deconstruct(self, raw_bytes):
@@ -52,7 +76,10 @@ class Choke(Message):
         pass
 
     def construct(self):
-        return struct.pack(">Ib", self.length, self.id)
+        return HEADER.pack(self.length, self.id)
+
+    def pack_into(self, buffer, offset):
+        HEADER.pack_into(buffer, offset, self.length, self.id)
 
     @classmethod
     def deconstruct(self, raw_bytes):
@@ -69,7 +96,10 @@ class Unchoke(Message):
         pass
 
     def construct(self):
-        return struct.pack(">Ib", self.length, self.id)
+        return HEADER.pack(self.length, self.id)
+
+    def pack_into(self, buffer, offset):
+        HEADER.pack_into(buffer, offset, self.length, self.id)
 
     @classmethod
     def deconstruct(self, raw_bytes):
@@ -86,7 +116,10 @@ class Interested(Message):
         pass
 
     def construct(self):
-        return struct.pack(">Ib", self.length, self.id)
+        return HEADER.pack(self.length, self.id)
+
+    def pack_into(self, buffer, offset):
+        HEADER.pack_into(buffer, offset, self.length, self.id)
 
     @classmethod
     def deconstruct(self, raw_bytes):
@@ -103,7 +136,10 @@ class Uninterested(Message):
         pass
 
     def construct(self):
-        return struct.pack(">Ib", self.length, self.id)
+        return HEADER.pack(self.length, self.id)
+
+    def pack_into(self, buffer, offset):
+        HEADER.pack_into(buffer, offset, self.length, self.id)
 
     @classmethod
     def deconstruct(self, raw_bytes):
@@ -121,14 +157,17 @@ class Have(Message):
         self.piece_index = piece_index
 
     def construct(self):
-        return struct.pack(">IbI", self.length, self.id, self.piece_index)
+        return HAVE.pack(self.length, self.id, self.piece_index)
+
+    def pack_into(self, buffer, offset):
+        HAVE.pack_into(buffer, offset, self.length, self.id, self.piece_index)
 
     @classmethod
     def deconstruct(self, raw_bytes):
         if len(raw_bytes) != self.length or raw_bytes[0] != self.id:
             raise ValueError
 
-        payload = struct.unpack(">I", raw_bytes[1:])
+        payload = INDEX.unpack_from(raw_bytes, 1)
 
         return Have(*payload)
 
@@ -143,16 +182,19 @@ class Bitfield(Message):
         self.bitfield = bitfield
 
     def construct(self):
-        return struct.pack(f">Ib{self.payload_length}s", self.length, self.id, self.bitfield)
+        return HEADER.pack(self.length, self.id) + bytes(self.bitfield)
+
+    def pack_into(self, buffer, offset):
+        HEADER.pack_into(buffer, offset, self.length, self.id)
+        buffer[offset + 5:offset + 5 + self.payload_length] = self.bitfield
 
     @classmethod
     def deconstruct(self, raw_bytes):
         if raw_bytes[0] != self.id:
             raise ValueError
 
-        payload = struct.unpack(f">{len(raw_bytes)-1}s", raw_bytes[1:])
-
-        return Bitfield(*payload)
+        # like a Piece's block, the bitfield is a slice of raw_bytes that the handler copies
+        return Bitfield(raw_bytes[1:])
 
 class Request(Message):
     id = 6
@@ -165,14 +207,17 @@ class Request(Message):
         self.request_length = request_length
 
     def construct(self):
-        return struct.pack(">IbIII", self.length, self.id, self.index, self.begin, self.request_length)
+        return BLOCK.pack(self.length, self.id, self.index, self.begin, self.request_length)
+
+    def pack_into(self, buffer, offset):
+        BLOCK.pack_into(buffer, offset, self.length, self.id, self.index, self.begin, self.request_length)
 
     @classmethod
     def deconstruct(self, raw_bytes):
         if len(raw_bytes) != self.length or raw_bytes[0] != self.id:
             raise ValueError
 
-        payload = struct.unpack(f">III", raw_bytes[1:])
+        payload = BLOCK_PAYLOAD.unpack_from(raw_bytes, 1)
 
         return Request(*payload)
 
@@ -190,16 +235,22 @@ class Piece(Message):
         self.block = block
 
     def construct(self):
-        return struct.pack(f">IbII{self.payload_length}s", self.length, self.id, self.index, self.begin, self.block)
+        return self.header(self.index, self.begin, self.payload_length) + bytes(self.block)
+
+    ## the bytes in front of a block, so the block itself can be written out without copying
+    @classmethod
+    def header(self, index, begin, block_length):
+        return PIECE_HEADER.pack(9 + block_length, self.id, index, begin)
 
     @classmethod
     def deconstruct(self, raw_bytes):
         if raw_bytes[0] != self.id:
             raise ValueError
 
-        payload = struct.unpack(f">II{len(raw_bytes)-9}s", raw_bytes[1:])
+        # only unpack the header, the block stays a slice of raw_bytes (a view if raw_bytes is one)
+        (index, begin) = PIECE_PAYLOAD.unpack_from(raw_bytes, 1)
 
-        return Piece(*payload)
+        return Piece(index, begin, raw_bytes[9:])
 
 class Cancel(Message):
     id = 8
@@ -212,17 +263,134 @@ class Cancel(Message):
         self.request_length = request_length
 
     def construct(self):
-        return struct.pack(">IbIII", self.length, self.id, self.index, self.begin, self.request_length)
+        return BLOCK.pack(self.length, self.id, self.index, self.begin, self.request_length)
+
+    def pack_into(self, buffer, offset):
+        BLOCK.pack_into(buffer, offset, self.length, self.id, self.index, self.begin, self.request_length)
 
     @classmethod
     def deconstruct(self, raw_bytes):
         if len(raw_bytes) != self.length or raw_bytes[0] != self.id:
             raise ValueError
 
-        payload = struct.unpack(f">III", raw_bytes[1:])
+        payload = BLOCK_PAYLOAD.unpack_from(raw_bytes, 1)
 
         return Cancel(*payload)
 
+# Fast extension (BEP 6) messages, only sent to and accepted from peers that
+# set the fast bit in their handshake
+
+class SuggestPiece(Message):
+    id = 13
+    payload_length = 4
+    length = 5
+
+    def __init__(self, piece_index):
+        self.piece_index = piece_index
+
+    def construct(self):
+        return HAVE.pack(self.length, self.id, self.piece_index)
+
+    def pack_into(self, buffer, offset):
+        HAVE.pack_into(buffer, offset, self.length, self.id, self.piece_index)
+
+    @classmethod
+    def deconstruct(self, raw_bytes):
+        if len(raw_bytes) != self.length or raw_bytes[0] != self.id:
+            raise ValueError
+
+        payload = INDEX.unpack_from(raw_bytes, 1)
+
+        return SuggestPiece(*payload)
+
+class HaveAll(Message):
+    id = 14
+    length = 1
+
+    def __init__(self):
+        pass
+
+    def construct(self):
+        return HEADER.pack(self.length, self.id)
+
+    def pack_into(self, buffer, offset):
+        HEADER.pack_into(buffer, offset, self.length, self.id)
+
+    @classmethod
+    def deconstruct(self, raw_bytes):
+        if len(raw_bytes) != self.length or raw_bytes[0] != self.id:
+            raise ValueError
+
+        return HaveAll()
+
+class HaveNone(Message):
+    id = 15
+    length = 1
+
+    def __init__(self):
+        pass
+
+    def construct(self):
+        return HEADER.pack(self.length, self.id)
+
+    def pack_into(self, buffer, offset):
+        HEADER.pack_into(buffer, offset, self.length, self.id)
+
+    @classmethod
+    def deconstruct(self, raw_bytes):
+        if len(raw_bytes) != self.length or raw_bytes[0] != self.id:
+            raise ValueError
+
+        return HaveNone()
+
+class RejectRequest(Message):
+    id = 16
+    payload_length = 12
+    length = 13
+
+    def __init__(self, index, begin, request_length):
+        self.index = index
+        self.begin = begin
+        self.request_length = request_length
+
+    def construct(self):
+        return BLOCK.pack(self.length, self.id, self.index, self.begin, self.request_length)
+
+    def pack_into(self, buffer, offset):
+        BLOCK.pack_into(buffer, offset, self.length, self.id, self.index, self.begin, self.request_length)
+
+    @classmethod
+    def deconstruct(self, raw_bytes):
+        if len(raw_bytes) != self.length or raw_bytes[0] != self.id:
+            raise ValueError
+
+        payload = BLOCK_PAYLOAD.unpack_from(raw_bytes, 1)
+
+        return RejectRequest(*payload)
+
+class AllowedFast(Message):
+    id = 17
+    payload_length = 4
+    length = 5
+
+    def __init__(self, piece_index):
+        self.piece_index = piece_index
+
+    def construct(self):
+        return HAVE.pack(self.length, self.id, self.piece_index)
+
+    def pack_into(self, buffer, offset):
+        HAVE.pack_into(buffer, offset, self.length, self.id, self.piece_index)
+
+    @classmethod
+    def deconstruct(self, raw_bytes):
+        if len(raw_bytes) != self.length or raw_bytes[0] != self.id:
+            raise ValueError
+
+        payload = INDEX.unpack_from(raw_bytes, 1)
+
+        return AllowedFast(*payload)
+
 _MSG_TYPE = {
     0 : Choke,
     1 : Unchoke,
@@ -232,7 +400,12 @@ _MSG_TYPE = {
     5 : Bitfield,
     6 : Request,
     7 : Piece,
-    8 : Cancel
+    8 : Cancel,
+    13 : SuggestPiece,
+    14 : HaveAll,
+    15 : HaveNone,
+    16 : RejectRequest,
+    17 : AllowedFast,
 }
 
 def parse_message(raw_bytes):
@@ -0,0 +1,250 @@
+import os
+import time
+import asyncio
+
+# Prefix of every exposed metric
+PREFIX = "bitpour_"
+
+# Seconds between event loop lag probes
+LAG_INTERVAL = 0.25
+
+# Seconds a metrics client gets to send its request
+REQUEST_TIMEOUT = 5
+
+# Largest request a metrics client may send
+MAX_REQUEST_LENGTH = 1 << 13
+
+# name : (type, help) of every metric, exposed in this order
+METRICS = {
+    "event_loop_lag_seconds": ("gauge", "How late the last event loop lag probe woke up"),
+    "event_loop_lag_max_seconds": ("gauge", "Largest event loop lag seen so far"),
+    "connections": ("gauge", "Connections and attempts across every torrent"),
+    "disk_queue_length": ("gauge", "Pieces waiting for the disk writer"),
+
+    "torrent_pieces": ("gauge", "Pieces in the torrent"),
+    "torrent_pieces_completed": ("gauge", "Pieces verified and ours"),
+    "torrent_pieces_in_progress": ("gauge", "Pieces being downloaded"),
+    "torrent_hash_failures_total": ("counter", "Pieces that failed verification"),
+    "torrent_endgame": ("gauge", "1 while in endgame"),
+    "torrent_download_bytes_total": ("counter", "Bytes downloaded"),
+    "torrent_upload_bytes_total": ("counter", "Bytes uploaded"),
+    "torrent_download_rate_bytes_per_second": ("gauge", "Download rate over the connected peers"),
+    "torrent_upload_rate_bytes_per_second": ("gauge", "Upload rate over the connected peers"),
+    "torrent_peers": ("gauge", "Connected peers"),
+    "torrent_peers_unchoked": ("gauge", "Peers we upload to"),
+    "torrent_candidates": ("gauge", "Peers known from trackers and other sources"),
+    "torrent_connect_failures_total": ("counter", "Failed connection attempts"),
+    "torrent_evictions_total": ("counter", "Connections dropped for being too slow"),
+
+    "peer_download_rate_bytes_per_second": ("gauge", "Download rate from the peer"),
+    "peer_upload_rate_bytes_per_second": ("gauge", "Upload rate to the peer"),
+    "peer_download_bytes_total": ("counter", "Bytes downloaded from the peer"),
+    "peer_upload_bytes_total": ("counter", "Bytes uploaded to the peer"),
+    "peer_requests_outstanding": ("gauge", "Block requests in flight with the peer"),
+    "peer_request_queue_depth": ("gauge", "Block requests the pipeline aims to keep in flight"),
+    "peer_upload_queue_length": ("gauge", "Requests from the peer waiting to be served"),
+    "peer_choking": ("gauge", "1 if the peer chokes us"),
+    "peer_choked": ("gauge", "1 if we choke the peer"),
+    "peer_interested": ("gauge", "1 if the peer is interested in us"),
+    "peer_interesting": ("gauge", "1 if we are interested in the peer"),
+}
+
+# A class that measures how late the event loop runs callbacks, by sleeping
+# a fixed interval and looking at how much longer it actually took
+class LoopLag:
+    def __init__(self, interval=LAG_INTERVAL):
+        self.interval = interval
+
+        self.last = 0.0
+        self.max = 0.0
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+
+            self.last = max(loop.time() - start - self.interval, 0.0)
+            self.max = max(self.max, self.last)
+
+# A class that collects the state of a session on demand and exposes it in
+# the Prometheus text format, over http on a local port or a unix socket,
+# and as an optional summary line printed every few seconds. Nothing is
+# counted on the hot path beyond what the session tracks anyway - samples
+# are only gathered when someone asks.
+class Metrics:
+    def __init__(self, session):
+        self.session = session
+        self.lag = LoopLag()
+
+        self.servers = []
+        self.tasks = []
+
+    ## start probing the loop, serving on port and/or path and printing a summary every interval seconds
+    async def start(self, port=None, path=None, interval=0):
+        self.tasks.append(asyncio.ensure_future(self.lag.run()))
+
+        if port is not None:
+            self.servers.append(await asyncio.start_server(self.handle, "127.0.0.1", port))
+
+        if path is not None:
+            # a socket left behind by an earlier run
+            if os.path.exists(path):
+                os.unlink(path)
+
+            self.servers.append(await asyncio.start_unix_server(self.handle, path))
+
+        if interval > 0:
+            self.tasks.append(asyncio.ensure_future(self.print_summary(interval)))
+
+    async def stop(self):
+        for server in self.servers:
+            server.close()
+
+        for task in self.tasks:
+            task.cancel()
+
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    ## answer a GET for /metrics with the current samples
+    async def handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), REQUEST_TIMEOUT)
+            if len(request) > MAX_REQUEST_LENGTH:
+                return
+
+            (method, target) = request.split(b" ", 2)[:2]
+            if method != b"GET":
+                response = (b"405 Method Not Allowed", b"")
+            elif target.split(b"?")[0] not in (b"/", b"/metrics"):
+                response = (b"404 Not Found", b"")
+            else:
+                response = (b"200 OK", self.render().encode())
+
+            (status, body) = response
+            writer.write(b"HTTP/1.0 %s\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: %d\r\n\r\n"
+                         % (status, len(body)) + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    ## name : list of (labels, value) for everything in the session right now
+    def collect(self):
+        samples = {name: [] for name in METRICS}
+
+        def add(name, labels, value):
+            samples[name].append((labels, value))
+
+        session = self.session
+        add("event_loop_lag_seconds", {}, self.lag.last)
+        add("event_loop_lag_max_seconds", {}, self.lag.max)
+        add("connections", {}, session.budget.num_connections())
+        add("disk_queue_length", {}, session.writer.queue.qsize())
+
+        for active in session.torrents.values():
+            # still checking existing data
+            if active.connections is None:
+                continue
+
+            connections = active.connections
+            picker = active.picker
+            workers = [peer_worker for peer_worker in connections.all_workers() if peer_worker.is_connected()]
+
+            torrent = {"torrent": active.torrent.filename, "info_hash": active.info_hash.hex()}
+            (uploaded, downloaded) = connections.transferred()
+            download_rates = [peer_worker.download_rate.rate() for peer_worker in workers]
+            upload_rates = [peer_worker.upload_rate.rate() for peer_worker in workers]
+
+            add("torrent_pieces", torrent, picker.num_pieces)
+            add("torrent_pieces_completed", torrent, picker.num_pieces - picker.remaining)
+            add("torrent_pieces_in_progress", torrent, len(picker.in_progress))
+            add("torrent_hash_failures_total", torrent, active.scheduler.hash_failures)
+            add("torrent_endgame", torrent, int(active.scheduler.endgame))
+            add("torrent_download_bytes_total", torrent, downloaded)
+            add("torrent_upload_bytes_total", torrent, uploaded)
+            add("torrent_download_rate_bytes_per_second", torrent, sum(download_rates))
+            add("torrent_upload_rate_bytes_per_second", torrent, sum(upload_rates))
+            add("torrent_peers", torrent, len(workers))
+            add("torrent_peers_unchoked", torrent, sum(1 for peer_worker in workers if not peer_worker.peer.client_choking))
+            add("torrent_candidates", torrent, len(connections.candidates))
+            add("torrent_connect_failures_total", torrent, connections.connect_failures)
+            add("torrent_evictions_total", torrent, connections.evictions)
+
+            for (peer_worker, download_rate, upload_rate) in zip(workers, download_rates, upload_rates):
+                peer = peer_worker.peer
+                labels = {"info_hash": torrent["info_hash"], "peer": str(peer)}
+
+                add("peer_download_rate_bytes_per_second", labels, download_rate)
+                add("peer_upload_rate_bytes_per_second", labels, upload_rate)
+                add("peer_download_bytes_total", labels, peer_worker.download_rate.total)
+                add("peer_upload_bytes_total", labels, peer_worker.upload_rate.total)
+                add("peer_requests_outstanding", labels, active.scheduler.num_outstanding(peer_worker))
+                add("peer_request_queue_depth", labels, peer_worker.queue_depth())
+                add("peer_upload_queue_length", labels, len(peer_worker.upload_queue))
+                add("peer_choking", labels, int(peer.peer_choking))
+                add("peer_choked", labels, int(peer.client_choking))
+                add("peer_interested", labels, int(peer.peer_interested))
+                add("peer_interesting", labels, int(peer.client_interested))
+
+        return samples
+
+    ## every metric in the Prometheus text exposition format
+    def render(self):
+        lines = []
+
+        for (name, samples) in self.collect().items():
+            if not samples:
+                continue
+
+            (kind, description) = METRICS[name]
+            lines.append(f"# HELP {PREFIX}{name} {description}")
+            lines.append(f"# TYPE {PREFIX}{name} {kind}")
+
+            for (labels, value) in samples:
+                lines.append(f"{PREFIX}{name}{_format_labels(labels)} {_format_value(value)}")
+
+        return "\n".join(lines) + "\n"
+
+    ## one line on how the whole session is doing
+    def summary(self):
+        samples = self.collect()
+
+        def total(name):
+            return sum(value for (_, value) in samples[name])
+
+        pieces = total("torrent_pieces")
+        completed = total("torrent_pieces_completed")
+        percent = 100 * completed / pieces if pieces else 0.0
+
+        return (f"{completed}/{pieces} pieces ({percent:.1f}%), "
+                f"down {total('torrent_download_rate_bytes_per_second') / 1e6:.2f} MB/s, "
+                f"up {total('torrent_upload_rate_bytes_per_second') / 1e6:.2f} MB/s, "
+                f"{total('torrent_peers')} peers, "
+                f"{total('torrent_hash_failures_total')} hash failures, "
+                f"loop lag {self.lag.last * 1000:.1f} ms")
+
+    async def print_summary(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            print(f"{time.strftime('%H:%M:%S')} {self.summary()}")
+
+## {key="value",...} with the values escaped, empty for no labels
+def _format_labels(labels):
+    if not labels:
+        return ""
+
+    pairs = []
+    for (key, value) in labels.items():
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        pairs.append(f"{key}=\"{value}\"")
+
+    return "{" + ",".join(pairs) + "}"
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+
+    return str(value)
@@ -1,13 +1,25 @@
 import ipaddress
 
-class BitfieldNotSetError(Exception):
-    pass
+from bitfield import Bitfield
 
 class Peer:
-    def __init__(self, raw_ip_bytes):
-        self.host = ipaddress.ip_address(raw_ip_bytes[:4])
-        self.port = int.from_bytes(raw_ip_bytes[4:], byteorder="big")
+    def __init__(self, host, port):
+        self.host = ipaddress.ip_address(host)
+        self.port = port
 
+        # the same peer reached over ipv6 as an ipv4-mapped address
+        if self.host.version == 6 and self.host.ipv4_mapped is not None:
+            self.host = self.host.ipv4_mapped
+
+        self.reset()
+
+    ## parse a peer from the compact format - 4 byte ip (16 for ipv6), 2 byte port
+    @classmethod
+    def from_bytes(cls, raw_ip_bytes):
+        return cls(bytes(raw_ip_bytes[:-2]), int.from_bytes(raw_ip_bytes[-2:], byteorder="big"))
+
+    ## forget everything learnt over a previous connection
+    def reset(self):
         # are we choking/interested in the peer
         self.client_choking = True
         self.client_interested = False
@@ -16,31 +28,14 @@ class Peer:
         self.peer_choking = True
         self.peer_interested = False
 
-        self.bitfield = bytearray(b"")
-
-    def has_bit(self, index):
-        if self.bitfield:
-            # get the byte by dividing by 8
-            bf_byte = self.bitfield[index >> 3]
-
-            # index & 7 to get index in that byte. subtract from 7 so it it left to right.
-            return (bf_byte >> (7 - (index & 7))) & 1
-        else:
-            raise BitfieldNotSetError
-
-    def set_bit(self, index, bit):
-        if not isinstance(bit, int):
-            raise TypeError
-
-        if self.bitfield:
-            # get the byte by dividing by 8
-            # index & 7 to get index in that byte. subtract from 7 so it it left to right.
-            if bit == 1:
-                self.bitfield[index >> 3] = self.bitfield[index >> 3] | (1 << (7 - (index & 7)))
-            elif bit == 0:
-               self.bitfield[index >> 3] = self.bitfield[index >> 3] & ~(1 << (7 - (index & 7))) 
-            else:
-                raise ValueError
-        else:
-            raise BitfieldNotSetError 
+        # pieces the peer has, empty until it tells us otherwise
+        self.bitfield = Bitfield()
+
+        # pieces the peer lets us download while it chokes us (fast extension)
+        self.allowed_fast = Bitfield()
+
+    def __str__(self):
+        if self.host.version == 6:
+            return f"[{self.host.compressed}]:{self.port}"
 
+        return f"{self.host.exploded}:{self.port}"
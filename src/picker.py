@@ -0,0 +1,140 @@
+import asyncio
+
+from bitfield import Bitfield
+
+# Number of pieces picked at random before switching to rarest first,
+# so we have something to trade as soon as possible
+RANDOM_FIRST_PIECES = 4
+
+# A class that decides which piece a peer should download next.
+# How many connected peers have each piece is kept as a binary counter
+# sliced across bitfields - plane k holds bit k of every piece's count - so
+# adding a peer's bitfield is a ripple carry over a few planes, and finding
+# the rarest pieces a peer has is a handful of bitfield operations rather
+# than a walk over every piece.
+class PiecePicker:
+    def __init__(self, num_pieces, missing):
+        self.num_pieces = num_pieces
+
+        # availability counter, least significant plane first
+        self.planes = []
+
+        # wanted pieces nobody is downloading
+        self.wanted = Bitfield.from_indices(missing)
+
+        self.in_progress = Bitfield()
+        self.remaining = len(self.wanted)
+        self.completed = 0
+
+        self.finished = asyncio.Event()
+        if self.remaining == 0:
+            self.finished.set()
+
+        # set (and replaced) whenever a piece becomes pickable again
+        self.changed = asyncio.Event()
+
+    def is_finished(self):
+        return self.finished.is_set()
+
+    ## wait until a piece is put back or the download finishes
+    ## the event is taken now, not when the waiter first runs, so a notify in between isn't missed
+    def wait_changed(self):
+        return self.changed.wait()
+
+    def notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    ## a peer announced a piece with a Have message
+    def peer_has(self, index):
+        if index < self.num_pieces:
+            self.count_up(1 << index)
+
+    ## add (or remove, when disconnecting) every piece in a peer's bitfield
+    def add_bitfield(self, bitfield):
+        self.count_up(bitfield.bits)
+
+    def remove_bitfield(self, bitfield):
+        self.count_down(bitfield.bits)
+
+    ## add one to the count of every piece in bits
+    def count_up(self, bits):
+        carry = bits
+        for (level, plane) in enumerate(self.planes):
+            if not carry:
+                return
+
+            self.planes[level] = plane ^ carry
+            carry &= plane
+
+        if carry:
+            self.planes.append(carry)
+
+    ## take one off the count of every piece in bits, which must all be counted
+    def count_down(self, bits):
+        borrow = bits
+        for (level, plane) in enumerate(self.planes):
+            if not borrow:
+                break
+
+            self.planes[level] = plane ^ borrow
+            borrow &= ~plane
+
+        while self.planes and not self.planes[-1]:
+            self.planes.pop()
+
+    ## number of connected peers that have a piece
+    def availability(self, index):
+        return sum(((plane >> index) & 1) << level for (level, plane) in enumerate(self.planes))
+
+    ## whether peer has any piece we still need
+    def is_interesting(self, peer):
+        return bool(peer.bitfield & (self.wanted | self.in_progress))
+
+    ## choose the next piece out of a peer's pieces, or None if it has nothing we want
+    def pick(self, pieces):
+        candidates = self.wanted & pieces
+        if not candidates:
+            return None
+
+        if self.completed >= RANDOM_FIRST_PIECES:
+            candidates = self.rarest(candidates)
+
+        # start from a random point so different peers start on different pieces
+        index = candidates.random_set(self.num_pieces)
+
+        self.wanted.discard(index)
+        self.in_progress.add(index)
+
+        return index
+
+    ## the candidates that the fewest peers have
+    def rarest(self, candidates):
+        bits = candidates.bits
+
+        # from the most significant plane down, keep the pieces whose count has a 0 there if there are any
+        for plane in reversed(self.planes):
+            fewer = bits & ~plane
+            if fewer:
+                bits = fewer
+
+        return Bitfield(bits)
+
+    ## the piece was downloaded and verified
+    def complete(self, index):
+        self.in_progress.discard(index)
+        self.completed += 1
+        self.remaining -= 1
+
+        if self.remaining == 0:
+            self.finished.set()
+            self.notify()
+
+    ## the piece failed or its peer went away, make it pickable again
+    def abort(self, index):
+        if index not in self.in_progress:
+            return
+
+        self.in_progress.discard(index)
+        self.wanted.add(index)
+        self.notify()
@@ -0,0 +1,38 @@
+import math
+import time
+
+# Seconds of history a rate is averaged over
+RATE_WINDOW = 5.0
+
+# A class that measures a transfer rate as an exponentially decaying average
+class RateMeter:
+    def __init__(self, window=RATE_WINDOW):
+        self.window = window
+
+        # bytes seen, each weighted by how long ago it was seen
+        self.value = 0.0
+
+        self.start = self.last = time.monotonic()
+        self.total = 0
+
+    def decay(self, now):
+        self.value *= math.exp((self.last - now) / self.window)
+        self.last = now
+
+    def add(self, nbytes):
+        self.decay(time.monotonic())
+        self.value += nbytes
+        self.total += nbytes
+
+    ## bytes per second
+    def rate(self):
+        now = time.monotonic()
+        self.decay(now)
+
+        # a constant rate over the meter's lifetime decays to rate * span,
+        # which keeps the estimate honest before a whole window has passed
+        span = self.window * (1 - math.exp((self.start - now) / self.window))
+        if span <= 0:
+            return 0.0
+
+        return self.value / span
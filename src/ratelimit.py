@@ -0,0 +1,102 @@
+import asyncio
+import time
+import weakref
+
+# Seconds worth of tokens a bucket can save up
+BURST_SECONDS = 0.5
+
+# Smallest burst, so a single block can always get through
+MIN_BURST = 1 << 16
+
+# A token bucket, rate is in bytes per second and 0 means unlimited.
+# Transfers are allowed to take the bucket into debt, and the caller is
+# told how long to hold off until the debt is paid back, so pacing never
+# needs to poll.
+class TokenBucket:
+    def __init__(self, rate=0):
+        self.set_rate(rate)
+
+        self.tokens = self.burst
+        self.last = time.monotonic()
+
+    def set_rate(self, rate):
+        self.rate = rate
+        self.burst = max(rate * BURST_SECONDS, MIN_BURST)
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    ## take nbytes worth of tokens, returns the seconds to wait before transferring more
+    def consume(self, nbytes):
+        if not self.rate:
+            return 0.0
+
+        self.refill(time.monotonic())
+        self.tokens -= nbytes
+
+        if self.tokens >= 0:
+            return 0.0
+
+        return -self.tokens / self.rate
+
+# A set of buckets that all have to allow a transfer, e.g. the global and a per peer one.
+# Because every transfer adds to the debt of the shared bucket, connections that come
+# later wait longer, so they take turns instead of the fastest one winning.
+class RateLimiter:
+    def __init__(self, *buckets):
+        self.buckets = buckets
+
+    def is_limited(self):
+        return any(bucket.rate for bucket in self.buckets)
+
+    def consume(self, nbytes):
+        return max(bucket.consume(nbytes) for bucket in self.buckets)
+
+    ## wait until nbytes may be sent
+    async def acquire(self, nbytes):
+        delay = self.consume(nbytes)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+# The configured limits - one global bucket per direction, plus a bucket per
+# direction for every connection, all of which can be changed while running
+class RateLimits:
+    def __init__(self, download=0, upload=0, peer_download=0, peer_upload=0):
+        self.download = TokenBucket(download)
+        self.upload = TokenBucket(upload)
+
+        self.peer_download = peer_download
+        self.peer_upload = peer_upload
+
+        # per peer buckets of live connections
+        self.peer_download_buckets = weakref.WeakSet()
+        self.peer_upload_buckets = weakref.WeakSet()
+
+    ## (download, upload) limiters for a new connection
+    def for_peer(self):
+        download = TokenBucket(self.peer_download)
+        upload = TokenBucket(self.peer_upload)
+
+        self.peer_download_buckets.add(download)
+        self.peer_upload_buckets.add(upload)
+
+        return (RateLimiter(self.download, download), RateLimiter(self.upload, upload))
+
+    ## change limits, None leaves a limit as it is
+    def set_limits(self, download=None, upload=None, peer_download=None, peer_upload=None):
+        if download is not None:
+            self.download.set_rate(download)
+
+        if upload is not None:
+            self.upload.set_rate(upload)
+
+        if peer_download is not None:
+            self.peer_download = peer_download
+            for bucket in self.peer_download_buckets:
+                bucket.set_rate(peer_download)
+
+        if peer_upload is not None:
+            self.peer_upload = peer_upload
+            for bucket in self.peer_upload_buckets:
+                bucket.set_rate(peer_upload)
@@ -0,0 +1,96 @@
+import os
+import mmap
+import time
+from hashlib import sha1
+from concurrent.futures import ThreadPoolExecutor
+
+from files import DataFiles
+
+# A class that hashes existing data against the torrent's piece hashes
+# using a pool of threads - hashlib releases the GIL while hashing
+class Recheck:
+    def __init__(self, torrent, workers=None):
+        self.torrent = torrent
+        self.workers = workers or os.cpu_count() or 1
+
+        # stats of the last run
+        self.bytes_checked = 0
+        self.elapsed = 0.0
+
+    ## throughput of the last run in MB/s
+    def throughput(self):
+        if self.elapsed == 0:
+            return 0.0
+
+        return self.bytes_checked / self.elapsed / 1e6
+
+    ## check the given piece indices (default all of them), returns the indices that match
+    def run(self, indices=None):
+        if indices is None:
+            indices = range(len(self.torrent.pieces))
+
+        start_time = time.perf_counter()
+        self.bytes_checked = 0
+
+        if len(self.torrent.files) == 1:
+            good = self.run_mapped(indices)
+        else:
+            good = self.run_files(indices)
+
+        self.elapsed = time.perf_counter() - start_time
+        return good
+
+    ## a single file is mapped and hashed in place
+    def run_mapped(self, indices):
+        try:
+            f = open(self.torrent.files[0].path, "rb")
+        except FileNotFoundError:
+            return []
+
+        with f:
+            size = os.fstat(f.fileno()).st_size
+
+            # an empty file can't be mapped, and has nothing valid in it anyway
+            if size == 0:
+                return []
+
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if hasattr(mm, "madvise"):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+
+                view = memoryview(mm)
+                try:
+                    def read(begin, length):
+                        return view[begin:min(begin + length, size)]
+
+                    return self.check_pieces(read, indices)
+                finally:
+                    view.release()
+
+    ## pieces of many files are read across file boundaries, the hashing still runs in parallel
+    def run_files(self, indices):
+        files = DataFiles(self.torrent, writable=False)
+        try:
+            return self.check_pieces(files.read, indices)
+        finally:
+            files.close()
+
+    ## hash the pieces with read(offset, length) returning their data
+    def check_pieces(self, read, indices):
+        def check(index):
+            length = self.torrent.get_piece_length(index)
+            data = read(index * self.torrent.piece_length, length)
+
+            # the data is too short to hold this piece
+            if len(data) < length:
+                return False
+
+            return sha1(data).digest() == self.torrent.pieces[index]
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            results = list(pool.map(check, indices))
+
+        good = [index for index, ok in zip(indices, results) if ok]
+        self.bytes_checked = sum(self.torrent.get_piece_length(index) for index in indices)
+
+        return good
@@ -0,0 +1,94 @@
+import os
+import bencode
+from recheck import Recheck
+from files import DataFiles
+
+# File name suffix of the resume file written next to the download
+RESUME_SUFFIX = ".resume"
+
+class ResumeParseError(Exception):
+    pass
+
+# A class that tracks which pieces are verified on disk and persists it
+# as a resume file so a restart can skip them
+class Resume:
+    def __init__(self, torrent, data_path):
+        self.data_path = data_path
+        self.path = data_path + RESUME_SUFFIX
+
+        self.files = DataFiles(torrent, writable=False)
+
+        self.info_hash = torrent.info_hash
+        self.num_pieces = len(torrent.pieces)
+        self.bitfield = bytearray((self.num_pieces + 7) >> 3)
+
+    def has_piece(self, index):
+        return (self.bitfield[index >> 3] >> (7 - (index & 7))) & 1
+
+    def set_piece(self, index):
+        self.bitfield[index >> 3] |= 1 << (7 - (index & 7))
+
+    ## indices of pieces that still need to be downloaded
+    def missing_pieces(self):
+        return [index for index in range(self.num_pieces) if not self.has_piece(index)]
+
+    ## load the resume file, returns True if it matches the data on disk and was applied
+    def load(self):
+        try:
+            with open(self.path, "rb") as f:
+                resume = bencode.decode(f.read())
+
+            (size, mtime) = self.files.stat()
+        except (OSError, bencode.BEncodeDecodeError):
+            return False
+
+        try:
+            if _raw(resume["info hash"]) != self.info_hash:
+                raise ResumeParseError("resume file is for a different torrent")
+
+            # the data was changed behind our back, the bitfield can't be trusted
+            if resume["size"] != size or resume["mtime"] != mtime:
+                raise ResumeParseError("data file changed since the resume file was written")
+
+            bitfield = _raw(resume["bitfield"])
+            if len(bitfield) != len(self.bitfield):
+                raise ResumeParseError("bitfield has the wrong length")
+        except (KeyError, TypeError, ResumeParseError):
+            return False
+
+        self.bitfield = bytearray(bitfield)
+        return True
+
+    ## write the resume file for the current state of the data files
+    def save(self):
+        (size, mtime) = self.files.stat()
+
+        resume = {
+            "bitfield"  : bytes(self.bitfield),
+            "info hash" : self.info_hash,
+            "mtime"     : mtime,
+            "size"      : size,
+        }
+
+        # write to a temporary file and rename so a crash never leaves a torn resume file
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(bencode.encode(resume))
+
+        os.replace(tmp_path, self.path)
+
+    ## hash existing data for every piece the resume file doesn't cover, returns the Recheck used
+    def check_existing(self, torrent, workers=None):
+        recheck = Recheck(torrent, workers)
+
+        for index in recheck.run(self.missing_pieces()):
+            self.set_piece(index)
+
+        return recheck
+
+## the decoder turns byte strings into str where it can, undo that
+def _raw(value):
+    if isinstance(value, str):
+        return value.encode()
+
+    return value
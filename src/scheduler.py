@@ -0,0 +1,242 @@
+import asyncio
+
+# Size of the blocks pieces are requested in
+BLOCK_SIZE = 16384
+
+# Block states
+FREE = 0
+REQUESTED = 1
+RECEIVED = 2
+
+# A piece that is being downloaded, possibly from several peers at once
+class PartialPiece:
+    def __init__(self, index, piece_hash, length, hasher):
+        self.index = index
+        self.length = length
+
+        self.buf = bytearray(length)
+        self.hash = hasher.piece(piece_hash, length)
+
+        self.num_blocks = (length + BLOCK_SIZE - 1) // BLOCK_SIZE
+        self.blocks = bytearray(self.num_blocks)
+        self.received = 0
+
+        # block number : set of owners that have it requested, more than one only in endgame
+        self.owners = {}
+
+    def block_length(self, block):
+        if block == self.num_blocks - 1:
+            return self.length - block * BLOCK_SIZE
+
+        return BLOCK_SIZE
+
+    def free_blocks(self):
+        return self.num_blocks - self.received - len(self.owners)
+
+    def is_complete(self):
+        return self.received == self.num_blocks
+
+# A class that hands out blocks to request across all connections.
+# It tracks every outstanding (index, begin, length) request and who made it,
+# so blocks of a piece can come from several peers and a peer going away
+# only gives back what it had requested, not what it already delivered.
+# Once every remaining block is requested it switches to endgame, where
+# outstanding blocks are handed out again to other peers and the losers of
+# each race are told to cancel.
+class BlockScheduler:
+    def __init__(self, torrent, picker, hasher, storage):
+        self.torrent = torrent
+        self.picker = picker
+        self.hasher = hasher
+        self.storage = storage
+
+        # index : PartialPiece for every piece with blocks still to download
+        self.partial = {}
+
+        # owner : set of (index, block) it has requested
+        self.outstanding = {}
+
+        # verification tasks in flight
+        self.tasks = set()
+
+        self.endgame = False
+
+        # pieces that failed verification
+        self.hash_failures = 0
+
+    def num_outstanding(self, owner):
+        return len(self.outstanding.get(owner, ()))
+
+    ## hand out up to count blocks for owner to request from peer, only from allowed pieces if given
+    def request_blocks(self, owner, peer, count, allowed=None):
+        requests = []
+        if count <= 0:
+            return requests
+
+        pieces = peer.bitfield if allowed is None else peer.bitfield & allowed
+
+        outstanding = self.outstanding.setdefault(owner, set())
+
+        # finish pieces that are already started before opening new ones, most complete first
+        partial = sorted(self.partial.values(), key=lambda piece: piece.free_blocks())
+        for piece in partial:
+            if piece.free_blocks() and piece.index in pieces:
+                self.take_blocks(owner, outstanding, piece, count - len(requests), requests)
+
+            if len(requests) == count:
+                return requests
+
+        while len(requests) < count:
+            index = self.picker.pick(pieces)
+            if index is None:
+                break
+
+            piece = PartialPiece(index, self.torrent.pieces[index], self.torrent.get_piece_length(index), self.hasher)
+            self.partial[index] = piece
+
+            self.take_blocks(owner, outstanding, piece, count - len(requests), requests)
+
+        if len(requests) < count and self.check_endgame():
+            for piece in partial:
+                if piece.index in pieces:
+                    self.take_duplicate_blocks(owner, outstanding, piece, count - len(requests), requests)
+
+                if len(requests) == count:
+                    break
+
+        return requests
+
+    ## endgame starts once there is nothing left that nobody has requested
+    def check_endgame(self):
+        if self.endgame:
+            return True
+
+        if self.picker.wanted or any(piece.free_blocks() for piece in self.partial.values()):
+            return False
+
+        # wake up idle connections so they can join in
+        self.endgame = True
+        self.picker.notify()
+
+        return True
+
+    def take_blocks(self, owner, outstanding, piece, count, requests):
+        for block in range(piece.num_blocks):
+            if count == 0:
+                return
+
+            if piece.blocks[block] != FREE:
+                continue
+
+            piece.blocks[block] = REQUESTED
+            piece.owners[block] = {owner}
+            outstanding.add((piece.index, block))
+
+            requests.append((piece.index, block * BLOCK_SIZE, piece.block_length(block)))
+            count -= 1
+
+    ## request blocks someone else is already waiting on, endgame only
+    def take_duplicate_blocks(self, owner, outstanding, piece, count, requests):
+        for (block, owners) in piece.owners.items():
+            if count == 0:
+                return
+
+            if owner in owners:
+                continue
+
+            owners.add(owner)
+            outstanding.add((piece.index, block))
+
+            requests.append((piece.index, block * BLOCK_SIZE, piece.block_length(block)))
+            count -= 1
+
+    ## a block arrived, store it and kick off verification if its piece is done
+    def block_received(self, owner, index, begin, data):
+        piece = self.partial.get(index)
+
+        # a late block for a piece that is finished, or not a block boundary we asked for
+        if piece is None or begin % BLOCK_SIZE != 0:
+            return
+
+        block = begin // BLOCK_SIZE
+        if block >= piece.num_blocks or piece.blocks[block] == RECEIVED or len(data) != piece.block_length(block):
+            return
+
+        piece.buf[begin:begin + len(data)] = data
+        piece.hash.block_received(piece.buf, begin, len(data))
+
+        piece.blocks[block] = RECEIVED
+        piece.received += 1
+
+        for requester in piece.owners.pop(block, ()):
+            self.outstanding[requester].discard((index, block))
+
+            # someone else won the race, stop the others from sending it too
+            if requester is not owner:
+                requester.cancel_block(index, begin, len(data))
+
+        if piece.is_complete():
+            del self.partial[index]
+
+            task = asyncio.ensure_future(self.finish_piece(piece))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    ## give back every block owner has requested but not received
+    def release(self, owner):
+        outstanding = self.outstanding.pop(owner, ())
+
+        for (index, block) in outstanding:
+            self.release_block(owner, index, block)
+
+        if outstanding:
+            self.picker.notify()
+
+    ## the peer owner requested a block from won't send it, give it back right away
+    def block_rejected(self, owner, index, begin):
+        if begin % BLOCK_SIZE != 0:
+            return
+
+        block = begin // BLOCK_SIZE
+        outstanding = self.outstanding.get(owner)
+        if outstanding is None or (index, block) not in outstanding:
+            return
+
+        outstanding.discard((index, block))
+        self.release_block(owner, index, block)
+        self.picker.notify()
+
+    def release_block(self, owner, index, block):
+        piece = self.partial.get(index)
+        if piece is None or piece.blocks[block] != REQUESTED:
+            return
+
+        owners = piece.owners[block]
+        owners.discard(owner)
+
+        if not owners:
+            piece.blocks[block] = FREE
+            del piece.owners[block]
+
+            # there is a block nobody is fetching again
+            self.endgame = False
+
+    ## drop pieces that are still being verified
+    async def stop(self):
+        tasks = list(self.tasks)
+        for task in tasks:
+            task.cancel()
+
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    ## verify a complete piece and pass it on to the writer
+    async def finish_piece(self, piece):
+        if not await self.hasher.verify(piece.hash, piece.buf):
+            self.hash_failures += 1
+            self.picker.abort(piece.index)
+            self.endgame = False
+            return
+
+        # the buffer is handed over as is, every piece gets a fresh one
+        await self.storage.put(piece.index, piece.buf)
+        self.picker.complete(piece.index)
@@ -0,0 +1,264 @@
+import asyncio
+
+from storage import Storage, DiskWriter
+from resume import Resume
+from picker import PiecePicker
+from scheduler import BlockScheduler
+from manager import ConnectionManager, ConnectionBudget
+from choker import Choker
+from stream import start_server
+from tracker import Tracker
+import manager
+import worker
+import choker
+
+# Length of the handshake a peer opens a connection with
+HANDSHAKE_LENGTH = 68
+
+# Seconds an incoming peer gets to send its handshake
+HANDSHAKE_TIMEOUT = 10
+
+# A torrent running in a session, with its own storage, picker and peers
+class ActiveTorrent:
+    def __init__(self, session, torrent):
+        self.session = session
+        self.torrent = torrent
+        self.info_hash = torrent.info_hash
+
+        self.resume = None
+        self.storage = None
+        self.picker = None
+        self.scheduler = None
+        self.connections = None
+        self.tracker = None
+
+        self.tasks = []
+
+        # pieces were missing when we started, so finishing is worth announcing
+        self.downloading = False
+
+        # set with the error that stopped the torrent, if one did
+        self.error = None
+        self.failed = asyncio.Event()
+
+    ## load what is already on disk and start connecting to peers
+    async def start(self, peers=()):
+        session = self.session
+        torrent = self.torrent
+
+        # trust the resume file if it matches the data on disk, it is saved after every write so
+        # its bitfield is exact - existing data is only hashed without one
+        self.resume = Resume(torrent, torrent.filename)
+        resumed = self.resume.load()
+        if resumed:
+            print(f"{torrent.filename}: loaded resume data")
+
+        # preallocating and hashing existing data take a while, keep the other torrents going meanwhile
+        loop = asyncio.get_running_loop()
+
+        self.storage = Storage(torrent, session.writer, resume=self.resume)
+        await loop.run_in_executor(None, self.storage.open)
+
+        if self.storage.existing and not resumed:
+            await loop.run_in_executor(None, self.resume.check_existing, torrent, session.hasher.workers)
+
+        missing = self.resume.missing_pieces()
+        print(f"{torrent.filename}: {len(torrent.pieces) - len(missing)}/{len(torrent.pieces)} pieces already downloaded")
+
+        self.picker = PiecePicker(len(torrent.pieces), missing)
+        self.scheduler = BlockScheduler(torrent, self.picker, session.hasher, self.storage)
+
+        self.connections = ConnectionManager(torrent, session.peer_id, self.scheduler, self.storage,
+                                             min_requests=session.min_requests, max_requests=session.max_requests,
+                                             seed=session.seed, limits=session.limits, budget=session.budget)
+        self.connections.choker = Choker(self.connections.all_workers, self.picker, session.upload_slots)
+        self.connections.add_peers(peers)
+
+        # peers that have pieces from us need to hear about every new one
+        self.storage.on_written = self.connections.broadcast_have
+        self.storage.on_error = self.fail
+
+        self.tracker = Tracker(torrent, session.peer_id, session.port, self.progress)
+        self.tracker.on_peers = self.connections.add_peers
+        self.connections.on_starved = self.tracker.request_peers
+
+        self.tasks = [asyncio.ensure_future(self.connections.run()),
+                      asyncio.ensure_future(self.connections.choker.run()),
+                      asyncio.ensure_future(self.tracker.run())]
+
+        # only a download we actually did is announced as completed
+        self.downloading = bool(missing)
+        if self.downloading:
+            self.tasks.append(asyncio.ensure_future(self.announce_completed()))
+
+    ## (uploaded, downloaded, left) bytes, as reported to the trackers
+    def progress(self):
+        (uploaded, downloaded) = self.connections.transferred()
+
+        left = sum(self.torrent.get_piece_length(index) for index in self.resume.missing_pieces())
+        return (uploaded, downloaded, left)
+
+    async def announce_completed(self):
+        if await self.wait_finished():
+            self.tracker.completed()
+
+    def add_peers(self, peers):
+        self.connections.add_peers(peers)
+
+    ## wait until every piece is downloaded and on disk, returns False if the torrent failed instead
+    async def wait_finished(self):
+        finished = asyncio.ensure_future(self.picker.finished.wait())
+        failed = asyncio.ensure_future(self.failed.wait())
+
+        try:
+            await asyncio.wait({finished, failed}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            finished.cancel()
+            failed.cancel()
+
+        if self.error is not None:
+            return False
+
+        await self.storage.flush()
+        return self.error is None
+
+    ## the torrent can't go on, e.g. its data can't be written - stop it and leave the others running
+    def fail(self, error):
+        if self.error is not None:
+            return
+
+        print(f"{self.torrent.filename}: stopped - {error}")
+        self.error = error
+        self.failed.set()
+
+        self.session.drop(self)
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+
+        # announce_completed may not have got to run, tracker.stop sends a completed that is still due
+        if self.tracker is not None and self.downloading and self.picker.finished.is_set() and self.error is None:
+            self.tracker.completed()
+
+        if self.tracker is not None:
+            await self.tracker.stop()
+
+        if self.connections is not None:
+            await self.connections.stop()
+            await self.scheduler.stop()
+
+        # pieces still queued for the writer would be written to closed files otherwise
+        if self.storage is not None:
+            await self.storage.flush()
+            self.storage.close()
+            self.resume.save()
+
+# A class that runs any number of torrents in one event loop. The torrents
+# share the listening port - incoming peers are handed to the torrent named
+# in their handshake - as well as the connection budget, the disk writer,
+# the hashing pool and the rate limits. Torrents can be added and removed
+# while the session runs.
+class Session:
+    def __init__(self, peer_id, port, hasher, limits=None,
+                 max_connections=manager.MAX_CONNECTIONS, max_half_open=manager.MAX_HALF_OPEN,
+                 min_requests=worker.MIN_REQUESTS, max_requests=worker.MAX_REQUESTS,
+                 upload_slots=choker.UPLOAD_SLOTS, seed=False):
+        self.peer_id = peer_id
+        self.port = port
+        self.hasher = hasher
+        self.limits = limits
+        self.min_requests = min_requests
+        self.max_requests = max_requests
+        self.upload_slots = upload_slots
+        self.seed = seed
+
+        self.budget = ConnectionBudget(max_connections, max_half_open)
+        self.writer = DiskWriter()
+
+        # info_hash : ActiveTorrent
+        self.torrents = {}
+
+        self.server = None
+        self.writer_task = None
+        self.tasks = set()
+
+        # torrents that failed and are being stopped
+        self.stopping = set()
+
+    async def start(self):
+        self.writer_task = asyncio.ensure_future(self.writer.run())
+
+        try:
+            self.server = await start_server(self.accept, "0.0.0.0", self.port)
+        except OSError as e:
+            print(f"Could not listen on port {self.port} - {e}")
+
+    ## start running a torrent, returns its ActiveTorrent
+    async def add(self, torrent, peers=()):
+        if torrent.info_hash in self.torrents:
+            raise ValueError(f"{torrent.filename} is already in the session")
+
+        active = ActiveTorrent(self, torrent)
+        self.torrents[torrent.info_hash] = active
+
+        try:
+            await active.start(peers)
+        except BaseException:
+            del self.torrents[torrent.info_hash]
+            await active.stop()
+            raise
+
+        return active
+
+    ## stop a torrent and drop its peers
+    async def remove(self, info_hash):
+        active = self.torrents.pop(info_hash)
+        await active.stop()
+
+    ## stop a torrent that failed, without waiting for it
+    def drop(self, active):
+        if self.torrents.get(active.info_hash) is not active:
+            return
+
+        del self.torrents[active.info_hash]
+
+        task = asyncio.ensure_future(active.stop())
+        self.stopping.add(task)
+        task.add_done_callback(self.stopping.discard)
+
+    ## a peer connected to us, called by the listening server
+    def accept(self, stream):
+        task = asyncio.ensure_future(self.dispatch(stream))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    ## hand an incoming peer to the torrent its handshake asks for
+    async def dispatch(self, stream):
+        try:
+            handshake = await stream.peek(HANDSHAKE_LENGTH, HANDSHAKE_TIMEOUT)
+        except Exception:
+            stream.transport.close()
+            return
+
+        # the worker reads the handshake again and checks the rest of it
+        active = self.torrents.get(handshake[28:48])
+        if active is None or active.connections is None:
+            stream.transport.close()
+            return
+
+        active.connections.accept(stream)
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+
+        for task in list(self.tasks):
+            task.cancel()
+
+        # in parallel, so the trackers hear we are stopping without waiting on each other
+        await asyncio.gather(*(self.remove(info_hash) for info_hash in list(self.torrents)))
+        await asyncio.gather(*self.stopping, return_exceptions=True)
+
+        if self.writer_task is not None:
+            self.writer_task.cancel()
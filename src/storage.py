@@ -0,0 +1,189 @@
+import mmap
+import asyncio
+
+from files import DataFiles
+
+# Max number of verified pieces waiting to be written to disk
+WRITE_QUEUE_SIZE = 16
+
+# A class that owns the data files and writes verified pieces into place
+class Storage:
+    def __init__(self, torrent, writer, resume=None):
+        self.length = torrent.length
+        self.piece_length = torrent.piece_length
+
+        # resume data to update as pieces hit the disk
+        self.resume = resume
+
+        self.files = DataFiles(torrent)
+
+        # whether there was data here before us that may hold valid pieces, known once open
+        self.existing = False
+
+        # a single file is mapped read only and uploads are served straight from the mapping,
+        # with many files there'd be a descriptor per mapping so blocks are read instead
+        self.mm = None
+        self.view = None
+
+        # called with the index of every piece once it is on disk
+        self.on_written = None
+
+        # called with the error when pieces could not be written
+        self.on_error = None
+
+        # the writer our pieces go through, and how many of them it still holds
+        self.writer = writer
+        self.unwritten = 0
+        self.flushed = asyncio.Event()
+        self.flushed.set()
+
+    ## create the files and map a single one, which preallocates it - blocking, run it in a thread
+    def open(self):
+        self.existing = self.files.existing()
+        self.files.create_empty()
+
+        if len(self.files.files) == 1 and self.length > 0:
+            with self.files.lock:
+                self.mm = mmap.mmap(self.files.fd(0), self.length, access=mmap.ACCESS_READ)
+            self.view = memoryview(self.mm)
+
+    ## write a piece at index * piece_length, across as many files as it covers
+    def write_piece(self, index, piece):
+        self.files.write(index * self.piece_length, piece)
+
+    ## read a piece back from disk
+    def read_piece(self, index, length):
+        return self.files.read(index * self.piece_length, length)
+
+    ## a block of a piece we have, as a view into the mapped file when there is one
+    async def read_block(self, index, begin, length):
+        offset = index * self.piece_length + begin
+
+        if self.view is not None:
+            return self.view[offset:offset + length]
+
+        # read in a thread, the writer may hold the files for a whole piece or a preallocation
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.files.read, offset, length)
+
+    def has_piece(self, index):
+        return self.resume is not None and self.resume.has_piece(index)
+
+    ## bitfield of the pieces on disk, to send to peers
+    def bitfield(self):
+        if self.resume is None:
+            return bytes(0)
+
+        return bytes(self.resume.bitfield)
+
+    ## write a batch of pieces, then record them in the resume file
+    def write_pieces(self, pieces):
+        for (index, piece) in pieces:
+            self.write_piece(index, piece)
+
+        if self.resume is not None:
+            for (index, piece) in pieces:
+                self.resume.set_piece(index)
+
+            self.resume.save()
+
+    ## hand a verified piece to the writer, waits while the writer's queue is full
+    async def put(self, index, piece):
+        self.unwritten += 1
+        self.flushed.clear()
+
+        try:
+            await self.writer.queue.put((self, index, piece))
+        except BaseException:
+            # never made it into the queue
+            self.unwritten -= 1
+            if not self.unwritten:
+                self.flushed.set()
+            raise
+
+    ## the writer is done with our pieces
+    def pieces_written(self, pieces):
+        self.unwritten -= len(pieces)
+        if not self.unwritten:
+            self.flushed.set()
+
+        if self.on_written is not None:
+            for (index, piece) in pieces:
+                self.on_written(index)
+
+    ## the writer failed to write our pieces, they are dropped
+    def write_failed(self, pieces, error):
+        self.unwritten -= len(pieces)
+        if not self.unwritten:
+            self.flushed.set()
+
+        if self.on_error is not None:
+            self.on_error(error)
+
+    ## wait until every piece handed to put is on disk
+    async def flush(self):
+        await self.flushed.wait()
+
+    def close(self):
+        if self.files is None:
+            return
+
+        if self.mm is not None:
+            try:
+                self.view.release()
+            except BufferError:
+                pass
+
+            # blocks still queued in a transport keep the mapping alive, it goes once they are sent
+            try:
+                self.mm.close()
+            except BufferError:
+                pass
+
+        self.files.sync()
+        self.files.close()
+        self.files = None
+
+# The writer stage - one task that drains verified pieces of every torrent
+# onto disk. The queue is bounded so that at most a handful of verified
+# pieces sit in memory. A torrent whose pieces can't be written is told so
+# and the writer carries on with the others.
+class DiskWriter:
+    def __init__(self, queue_size=WRITE_QUEUE_SIZE):
+        self.queue = asyncio.Queue(maxsize=queue_size)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            # take everything that is already waiting so each resume file is saved once per batch
+            items = [await self.queue.get()]
+            while not self.queue.empty():
+                items.append(self.queue.get_nowait())
+
+            batches = {}
+            for (storage, index, piece) in items:
+                batches.setdefault(storage, []).append((index, piece))
+
+            try:
+                errors = await loop.run_in_executor(None, self.write_batches, batches)
+            finally:
+                for _ in items:
+                    self.queue.task_done()
+
+            for (storage, pieces) in batches.items():
+                if storage in errors:
+                    storage.write_failed(pieces, errors[storage])
+                else:
+                    storage.pieces_written(pieces)
+
+    ## write every batch, returns storage : error for the ones that failed
+    def write_batches(self, batches):
+        errors = {}
+        for (storage, pieces) in batches.items():
+            try:
+                storage.write_pieces(pieces)
+            except OSError as e:
+                errors[storage] = e
+
+        return errors
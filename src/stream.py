@@ -0,0 +1,346 @@
+import asyncio
+
+# Size of the preallocated receive buffer of a connection
+RECV_BUFFER_SIZE = 1 << 17
+
+# Messages bigger than this are treated as a protocol error rather than buffered
+MAX_MESSAGE_LENGTH = 1 << 21
+
+# Seconds to wait for a read before giving up on the peer
+READ_TIMEOUT = 150
+
+# Bytes of small frames collected per connection before they are written out
+SEND_BUFFER_SIZE = 1 << 12
+
+# Most bytes taken off the socket at once while reading is rate limited,
+# small enough that limited connections take turns at a fine grain
+LIMITED_READ_SIZE = 1 << 14
+
+class StreamClosedError(Exception):
+    pass
+
+class MessageTooLongError(Exception):
+    pass
+
+# Protocol that receives straight into a preallocated buffer and lets the
+# reader parse length prefixed frames out of it without copying
+class PeerProtocol(asyncio.BufferedProtocol):
+    def __init__(self, buffer_size=RECV_BUFFER_SIZE, connected_cb=None):
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+
+        # unconsumed data lives in buffer[start:end]
+        self.start = 0
+        self.end = 0
+
+        self.transport = None
+        self.paused_reading = False
+        self.paused_writing = False
+
+        # reading is paused while either the buffer is full or the download limit is exceeded
+        self.full = False
+        self.throttled = False
+        self.download_limit = None
+
+        # future the reader is parked on, and how many bytes it is waiting for
+        self.read_waiter = None
+        self.needed = 0
+
+        self.drain_waiter = None
+
+        self.eof = False
+        self.exception = None
+        self.closed = asyncio.get_event_loop().create_future()
+
+        # called with the new AsyncStream for connections accepted by a server
+        self.connected_cb = connected_cb
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+        if self.connected_cb is not None:
+            self.connected_cb(AsyncStream(transport, self))
+
+    def get_buffer(self, sizehint):
+        # everything was consumed, start over at the front for free
+        if self.start == self.end:
+            self.start = self.end = 0
+
+        # only a sliver left at the tail - move the partial frame to the front
+        elif len(self.buffer) - self.end < (len(self.buffer) >> 2):
+            self.compact()
+
+        if self.download_limit is not None and self.download_limit.is_limited():
+            return self.view[self.end:self.end + LIMITED_READ_SIZE]
+
+        return self.view[self.end:]
+
+    def buffer_updated(self, nbytes):
+        self.end += nbytes
+
+        if self.read_waiter is not None and self.end - self.start >= self.needed:
+            self.wake_reader()
+
+        # the buffer is full of unconsumed data, stop reading until the reader catches up
+        if self.end == len(self.buffer) and self.start == 0:
+            self.full = True
+            self.update_reading()
+
+        # over the limit, leave the rest in the socket until the debt is paid
+        if self.download_limit is not None:
+            delay = self.download_limit.consume(nbytes)
+
+            if delay > 0 and not self.throttled:
+                self.throttled = True
+                self.update_reading()
+                asyncio.get_running_loop().call_later(delay, self.unthrottle)
+
+    def eof_received(self):
+        self.eof = True
+        self.wake_reader()
+
+    def connection_lost(self, exc):
+        self.eof = True
+        self.exception = exc
+        self.wake_reader()
+
+        if self.drain_waiter is not None and not self.drain_waiter.done():
+            self.drain_waiter.set_result(None)
+
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+    def pause_writing(self):
+        self.paused_writing = True
+
+    def resume_writing(self):
+        self.paused_writing = False
+
+        if self.drain_waiter is not None and not self.drain_waiter.done():
+            self.drain_waiter.set_result(None)
+
+    def unthrottle(self):
+        self.throttled = False
+        self.update_reading()
+
+    ## there is room in the buffer again
+    def resume_reading(self):
+        if self.full:
+            self.full = False
+            self.update_reading()
+
+    def update_reading(self):
+        pause = self.full or self.throttled
+        if pause == self.paused_reading or self.transport.is_closing():
+            return
+
+        self.paused_reading = pause
+        if pause:
+            self.transport.pause_reading()
+        else:
+            self.transport.resume_reading()
+
+    def wake_reader(self):
+        if self.read_waiter is not None and not self.read_waiter.done():
+            self.read_waiter.set_result(None)
+
+    ## move unconsumed data to the front of the buffer
+    def compact(self):
+        length = self.end - self.start
+        self.view[:length] = self.view[self.start:self.end]
+        self.start = 0
+        self.end = length
+
+    ## make sure nbytes can fit in the buffer from self.start on
+    def reserve(self, nbytes):
+        if len(self.buffer) - self.start >= nbytes:
+            return
+
+        if len(self.buffer) >= nbytes:
+            self.compact()
+            return
+
+        # only frames bigger than the whole buffer get here (e.g. huge bitfields)
+        buffer = bytearray(max(nbytes, len(self.buffer) * 2))
+        length = self.end - self.start
+        buffer[:length] = self.view[self.start:self.end]
+
+        self.buffer = buffer
+        self.view = memoryview(buffer)
+        self.start = 0
+        self.end = length
+
+    ## wait until nbytes are buffered, with a single timer only if we actually have to wait
+    async def wait_for_data(self, nbytes, timeout):
+        if self.end - self.start >= nbytes:
+            return
+
+        self.reserve(nbytes)
+        self.resume_reading()
+
+        loop = asyncio.get_running_loop()
+        timer = None
+
+        try:
+            while self.end - self.start < nbytes:
+                if self.eof:
+                    raise StreamClosedError(self.exception or "connection closed by peer")
+
+                self.read_waiter = loop.create_future()
+                self.needed = nbytes
+
+                if timer is None:
+                    timer = loop.call_later(timeout, self.time_out)
+
+                await self.read_waiter
+        finally:
+            self.read_waiter = None
+
+            if timer is not None:
+                timer.cancel()
+
+    def time_out(self):
+        if self.read_waiter is not None and not self.read_waiter.done():
+            self.read_waiter.set_exception(asyncio.TimeoutError())
+
+    ## consume nbytes, returning a view into the receive buffer
+    def consume(self, nbytes):
+        data = self.view[self.start:self.start + nbytes]
+        self.start += nbytes
+
+        # there is room again
+        self.resume_reading()
+
+        return data
+
+# A framed stream to a peer
+# Views returned by the read functions point into the receive buffer and are
+# only valid until the caller next yields to the event loop
+class AsyncStream:
+    def __init__(self, transport, protocol):
+        self.transport = transport
+        self.protocol = protocol
+
+        self.upload_limit = None
+
+        # small frames queued in the current loop tick, written out together by flush
+        self.send_buffer = bytearray(SEND_BUFFER_SIZE)
+        self.send_length = 0
+        self.flush_handle = None
+
+    ## read exactly nbytes and return them as bytes
+    async def read(self, nbytes: int, timeout=READ_TIMEOUT):
+        await self.protocol.wait_for_data(nbytes, timeout)
+        return bytes(self.protocol.consume(nbytes))
+
+    ## wait for nbytes and return them as bytes without consuming them
+    async def peek(self, nbytes: int, timeout=READ_TIMEOUT):
+        await self.protocol.wait_for_data(nbytes, timeout)
+
+        start = self.protocol.start
+        return bytes(self.protocol.view[start:start + nbytes])
+
+    ## read one length prefixed message, returning its body as a memoryview
+    async def read_message(self, timeout=READ_TIMEOUT):
+        protocol = self.protocol
+
+        await protocol.wait_for_data(4, timeout)
+        msg_length = int.from_bytes(protocol.view[protocol.start:protocol.start + 4], byteorder="big")
+
+        if msg_length > MAX_MESSAGE_LENGTH:
+            raise MessageTooLongError(f"message of {msg_length} bytes")
+
+        await protocol.wait_for_data(4 + msg_length, timeout)
+        protocol.start += 4
+
+        return protocol.consume(msg_length)
+
+    ## apply rate limits to this connection - RateLimiters, or None for unlimited
+    def set_limits(self, download_limit, upload_limit):
+        self.protocol.download_limit = download_limit
+        self.upload_limit = upload_limit
+
+    def write(self, bytestring: bytes):
+        self.flush()
+        self.transport.write(bytestring)
+
+    ## queue a message, every message queued in the same loop tick goes out in one write
+    def send(self, message):
+        size = message.size()
+
+        if self.send_length + size > len(self.send_buffer):
+            self.flush()
+
+            # too big to be worth buffering
+            if size > len(self.send_buffer):
+                self.transport.write(message.construct())
+                return
+
+        message.pack_into(self.send_buffer, self.send_length)
+        self.send_length += size
+
+        if self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_soon(self.flush)
+
+    ## write out the queued messages
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+
+        if not self.send_length:
+            return
+
+        # the transport may hold on to what it is given, so it gets a copy and the buffer is reused
+        if not self.transport.is_closing():
+            self.transport.write(self.send_buffer[:self.send_length])
+
+        self.send_length = 0
+
+    ## write a block of data behind its header, waiting for the upload limit first
+    async def write_block(self, header, block):
+        if self.upload_limit is not None:
+            await self.upload_limit.acquire(len(block))
+
+            # the connection may have gone while we waited
+            if self.transport.is_closing():
+                return
+
+        self.flush()
+        self.transport.write(header)
+        self.transport.write(block)
+
+    async def drain(self):
+        self.flush()
+
+        protocol = self.protocol
+
+        if protocol.eof and protocol.exception is not None:
+            raise StreamClosedError(protocol.exception)
+
+        if not protocol.paused_writing:
+            return
+
+        protocol.drain_waiter = asyncio.get_running_loop().create_future()
+        await protocol.drain_waiter
+
+    async def close(self):
+        self.flush()
+        self.transport.close()
+        await self.protocol.closed
+
+    def is_closed(self):
+        return self.transport.is_closing()
+
+## open a connection to host:port and wrap it in an AsyncStream
+async def open_stream(host, port):
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_connection(PeerProtocol, host=host, port=port)
+
+    return AsyncStream(transport, protocol)
+
+## listen for incoming peers, connected_cb is called with an AsyncStream for each
+async def start_server(connected_cb, host, port):
+    loop = asyncio.get_running_loop()
+
+    return await loop.create_server(lambda: PeerProtocol(connected_cb=connected_cb), host=host, port=port)
@@ -1,28 +1,150 @@
+import os
 import bencode
 from hashlib import sha1
 
-# A class that represents the decoded torrent file/metafile
+# Size of a piece hash in the pieces blob
+HASH_LENGTH = 20
+
+class TorrentParseError(Exception):
+    pass
+
+# A file of the torrent, at offset within the concatenation of all files
+class TorrentFile:
+    __slots__ = ("path", "length", "offset")
+
+    def __init__(self, path, length, offset):
+        self.path = path
+        self.length = length
+        self.offset = offset
+
+# The piece hashes of a torrent, kept as the single blob from the metafile.
+# Indexing returns a zero-copy view of one 20 byte hash.
+class PieceHashes:
+    __slots__ = ("view", "count")
+
+    def __init__(self, blob):
+        self.view = memoryview(blob)
+        self.count = len(blob) // HASH_LENGTH
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+
+        if not 0 <= index < self.count:
+            raise IndexError("piece index out of range")
+
+        begin = index * HASH_LENGTH
+        return self.view[begin:begin + HASH_LENGTH]
+
+    def __iter__(self):
+        for index in range(self.count):
+            yield self[index]
+
+# A class that represents the decoded torrent file/metafile.
+# Only the handful of fields we need are kept, the pieces blob stays one
+# buffer and the info dict is hashed while reading, its raw bytes aren't kept.
 class Torrent:
+    __slots__ = ("announce", "trackers", "piece_length", "filename", "length", "files", "pieces", "info_hash")
+
     def __init__(self, torrent_path):
 
         ## open and decode torrent file
         with open(torrent_path, "rb") as f:
-            metafile = bencode.decode(f.read())
+            (metafile, raw_info) = bencode.decode(f.read(), raw="info")
+
+        if raw_info is None:
+            raise TorrentParseError("missing field 'info'")
+
+        # sha1 of the info dict as it appears in the file, re-encoding could change it
+        self.info_hash = sha1(raw_info).digest()
 
         ## set variables for easier access
-        self.announce = metafile["announce"]
-        self.piece_length = metafile["info"]["piece length"]
+        try:
+            info = metafile["info"]
+
+            self.announce = metafile.get("announce")
+            self.trackers = _tracker_tiers(metafile.get("announce-list"), self.announce)
+            self.piece_length = info["piece length"]
+            self.filename = _path_part(info["name"])
+            blob = info["pieces"]
+
+            if not isinstance(self.piece_length, int):
+                raise TorrentParseError("invalid piece length")
+
+            if not isinstance(blob, (bytes, str)):
+                raise TorrentParseError("invalid pieces")
 
-        # split the concatenated sha hashes into a list of hashes
-        self.pieces = [metafile["info"]["pieces"][i:i+20] for i in range(0, len(metafile["info"]["pieces"]), 20)]
+            # a single file is named after the torrent, multiple files go in a directory of that name
+            if "files" in info:
+                self.files = []
+                offset = 0
+                for entry in info["files"]:
+                    parts = [_path_part(part) for part in entry["path"]]
+                    if not parts:
+                        raise TorrentParseError("file with an empty path")
 
-        self.filename = metafile["info"]["name"]
-        self.length = metafile["info"]["length"]
-        self.info_hash = sha1(bencode.encode(metafile["info"])).digest()
+                    self.files.append(TorrentFile(os.path.join(self.filename, *parts), entry["length"], offset))
+                    offset += entry["length"]
+            else:
+                self.files = [TorrentFile(self.filename, info["length"], 0)]
+        except (KeyError, TypeError) as e:
+            raise TorrentParseError(f"missing field {e}")
+
+        if not self.trackers:
+            raise TorrentParseError("no trackers")
+
+        if any(not isinstance(f.length, int) or f.length < 0 for f in self.files):
+            raise TorrentParseError("invalid file length")
+
+        self.length = sum(f.length for f in self.files)
+
+        # a blob that happens to be valid utf8 was decoded to str
+        if isinstance(blob, str):
+            blob = blob.encode()
+
+        if len(blob) % HASH_LENGTH:
+            raise TorrentParseError("pieces is not a whole number of hashes")
+
+        self.pieces = PieceHashes(blob)
+
+        if self.piece_length <= 0 or len(self.pieces) != -(-self.length // self.piece_length):
+            raise TorrentParseError("number of pieces doesn't match the length")
 
     def get_piece_length(self, piece_index):
         if piece_index == len(self.pieces) - 1:
             return (self.length - (self.piece_length * (len(self.pieces) - 1)))
-            
 
-        return self.piece_length
\ No newline at end of file
+
+        return self.piece_length
+
+## tiers of tracker urls - announce-list if there is one, otherwise the lone announce url
+def _tracker_tiers(announce_list, announce):
+    tiers = []
+
+    if isinstance(announce_list, list):
+        for tier in announce_list:
+            if isinstance(tier, list):
+                urls = [url for url in tier if isinstance(url, str) and url]
+                if urls:
+                    tiers.append(urls)
+
+    if not tiers and isinstance(announce, str) and announce:
+        tiers.append([announce])
+
+    return tiers
+
+## a file or directory name from the metafile, refusing anything that would escape the download directory
+def _path_part(part):
+    if isinstance(part, bytes):
+        part = os.fsdecode(part)
+
+    if not isinstance(part, str):
+        raise TorrentParseError(f"invalid path {part!r}")
+
+    if part in ("", ".", "..") or "/" in part or os.sep in part or "\0" in part:
+        raise TorrentParseError(f"invalid path {part!r}")
+
+    return part
@@ -1,56 +1,470 @@
-import urllib.parse, urllib.request
+import asyncio
+import random
+import socket
+import struct
+import time
+import urllib.parse
 import bencode
+from peer import Peer
+
+# Seconds between announces if the tracker doesn't say
+DEFAULT_INTERVAL = 1800
+
+# Never announce more often than this, whatever the tracker says
+MIN_INTERVAL = 60
+
+# Seconds before trying again after every tracker failed, doubled each time
+RETRY_INTERVAL = 30
+MAX_RETRY_INTERVAL = 1800
+
+# Seconds to wait for an http tracker
+HTTP_TIMEOUT = 30
+
+# Largest http tracker response we read
+MAX_RESPONSE_LENGTH = 1 << 20
+
+# Seconds to wait for a udp tracker's reply, doubled on every retransmit (BEP 15)
+UDP_TIMEOUT = 15
+UDP_RETRIES = 2
+
+# Seconds a udp connection id may be used for
+UDP_CONNECTION_TTL = 60
+
+# Magic constant that opens a udp tracker connection
+UDP_PROTOCOL_ID = 0x41727101980
+
+# Seconds to wait for the stopped announce on the way out
+STOP_TIMEOUT = 5
+
+# udp tracker actions
+UDP_CONNECT = 0
+UDP_ANNOUNCE = 1
+UDP_ERROR = 3
+
+# Length of a compact ipv4 and ipv6 peer - address and 2 byte port
+PEER_LENGTH = 6
+PEER6_LENGTH = 18
+
+# Announce events, with their udp tracker codes
+EVENTS = {"": 0, "completed": 1, "started": 2, "stopped": 3}
 
 class TrackerParseError(Exception):
     pass
 
-class Tracker:
-    def __init__(self, torrent, peer_id, port):
+class TrackerError(Exception):
+    pass
 
-        # bytes uploaded
-        self.uploaded = 0
+# What a tracker told us
+class Announce:
+    def __init__(self, interval, min_interval, peers, seeders=None, leechers=None):
+        self.interval = interval
+        self.min_interval = min_interval
+        self.peers = peers
+        self.seeders = seeders
+        self.leechers = leechers
 
-        # bytes downloaded
-        self.downloaded = 0
+# A tracker spoken to over http(s)
+class HTTPTracker:
+    def __init__(self, url):
+        self.url = url
 
-        self.peer_id = peer_id
-        self.port = port
-        self.url = torrent.announce
-        self.info_hash = torrent.info_hash
-        self.file_size = torrent.length
+        # some trackers hand out an id to echo back on later announces
+        self.tracker_id = None
+
+    ## announce url with the parameters added to any query it already has
+    def construct_request(self, params):
+        if self.tracker_id is not None:
+            params["trackerid"] = self.tracker_id
+
+        ## parse url, encode and set params, and re-form url.
+        try:
+            request = urllib.parse.urlsplit(self.url)
+            query = urllib.parse.urlencode(params)
+            if request.query:
+                query = request.query + "&" + query
 
+            return request._replace(query=query)
+        except Exception as e:
+            raise TrackerParseError(e)
 
-    ## Construct a request to the tracker
-    def construct_request(self):
+    async def announce(self, info_hash, peer_id, port, uploaded, downloaded, left, event, key):
         params = {
-            "info_hash"  : self.info_hash,
-            "peer_id"    : self.peer_id,
-            "port"       : self.port,
-            "uploaded"   : self.uploaded,
-            "downloaded" : self.downloaded,
+            "info_hash"  : info_hash,
+            "peer_id"    : peer_id,
+            "port"       : port,
+            "uploaded"   : uploaded,
+            "downloaded" : downloaded,
+            "left"       : left,
             "compact"    : 1,
-            "left"       : self.file_size - self.downloaded,
+            "key"        : key,
         }
+        if event:
+            params["event"] = event
+
+        body = await asyncio.wait_for(self.get(self.construct_request(params)), HTTP_TIMEOUT)
 
-        ## parse url, encode and set params, and re-form url.
         try:
-            request = urllib.parse.urlparse(self.url)
-            params = urllib.parse.urlencode(params)
-            request = request._replace(query=params)
-            request = urllib.parse.urlunparse(request)
-        except Exception as e:
-            raise TrackerParseError(e)
+            response = bencode.decode(body)
+        except bencode.BEncodeDecodeError as e:
+            raise TrackerError(f"malformed response - {e}")
+
+        if not isinstance(response, dict):
+            raise TrackerError("malformed response")
+
+        if "failure reason" in response:
+            raise TrackerError(f"tracker refused - {response['failure reason']}")
+
+        if "warning message" in response:
+            print(f"{self.url}: {response['warning message']}")
 
-        return request
+        if "tracker id" in response:
+            self.tracker_id = response["tracker id"]
+
+        interval = response.get("interval", DEFAULT_INTERVAL)
+        min_interval = response.get("min interval", MIN_INTERVAL)
+        if not isinstance(interval, int) or not isinstance(min_interval, int):
+            raise TrackerError("malformed interval")
+
+        peers = parse_peers(response.get("peers", b"")) + parse_peers(response.get("peers6", b""), PEER6_LENGTH)
+        return Announce(interval, min_interval, peers, response.get("complete"), response.get("incomplete"))
+
+    ## a minimal http/1.0 GET, returning the body
+    async def get(self, request):
+        secure = request.scheme == "https"
+        port = request.port or (443 if secure else 80)
+
+        (reader, writer) = await asyncio.open_connection(request.hostname, port, ssl=True if secure else None)
+        try:
+            path = request.path or "/"
+            if request.query:
+                path += "?" + request.query
+
+            writer.write(f"GET {path} HTTP/1.0\r\nHost: {request.netloc}\r\nConnection: close\r\n\r\n".encode())
+
+            # http/1.0 - the response ends when the tracker closes the connection
+            chunks = []
+            length = 0
+            while chunk := await reader.read(1 << 16):
+                chunks.append(chunk)
+                length += len(chunk)
+
+                if length > MAX_RESPONSE_LENGTH:
+                    raise TrackerError("response too long")
+        finally:
+            writer.close()
+
+        response = b"".join(chunks)
+
+        (head, _, body) = response.partition(b"\r\n\r\n")
+        lines = head.split(b"\r\n")
+
+        status = lines[0].split(None, 2)
+        if len(status) < 2 or status[1] != b"200":
+            raise TrackerError(f"http error - {lines[0].decode(errors='replace')}")
+
+        headers = {}
+        for line in lines[1:]:
+            (name, _, value) = line.partition(b":")
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get(b"transfer-encoding", b"").lower() == b"chunked":
+            body = _dechunk(body)
+
+        return body
+
+# Receives the replies of a udp tracker, matching them to the request by transaction id
+class UDPTrackerProtocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.transport = None
+
+        self.transaction_id = None
+        self.waiter = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    ## send a request and get a future for the reply with the same transaction id
+    def request(self, packet, transaction_id):
+        self.transaction_id = transaction_id
+        self.waiter = asyncio.get_running_loop().create_future()
+        self.transport.sendto(packet)
+
+        return self.waiter
+
+    def datagram_received(self, data, addr):
+        if len(data) < 8 or self.waiter is None or self.waiter.done():
+            return
+
+        # anything else is a late reply to a request we gave up on
+        if int.from_bytes(data[4:8], "big") == self.transaction_id:
+            self.waiter.set_result(data)
+
+    def error_received(self, exc):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_exception(exc)
+
+    def connection_lost(self, exc):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_exception(exc or ConnectionError("udp tracker socket closed"))
+
+# A tracker spoken to over udp (BEP 15) - two small datagrams each way per announce
+class UDPTracker:
+    def __init__(self, url):
+        self.url = url
+
+        request = urllib.parse.urlsplit(url)
+        if request.hostname is None or request.port is None:
+            raise TrackerParseError(f"udp tracker without host or port - {url}")
+
+        self.address = (request.hostname, request.port)
+
+        self.connection_id = None
+        self.connected_at = 0.0
+
+    async def announce(self, info_hash, peer_id, port, uploaded, downloaded, left, event, key):
+        loop = asyncio.get_running_loop()
+        (transport, protocol) = await loop.create_datagram_endpoint(UDPTrackerProtocol, remote_addr=self.address)
+
+        try:
+            if self.connection_id is None or time.monotonic() - self.connected_at > UDP_CONNECTION_TTL:
+                await self.connect(protocol)
 
-    ## Send a request to the tracker and return a parsed response
-    def request(self):
-        tracker_request = self.construct_request()
+            def announce_packet(transaction_id):
+                return struct.pack(">QII20s20sQQQIIIiH", self.connection_id, UDP_ANNOUNCE, transaction_id,
+                                   info_hash, peer_id, downloaded, left, uploaded, EVENTS[event], 0, key, -1, port)
 
-        ## attempt to request tracker and decode the response
-        with urllib.request.urlopen(tracker_request) as response:
-            decoded_response = bencode.decode(response.read())
+            response = await self.exchange(protocol, announce_packet, UDP_ANNOUNCE, 20)
+
+            # a tracker reached over ipv6 answers with ipv6 peers
+            ipv6 = transport.get_extra_info("socket").family == socket.AF_INET6
+        finally:
+            transport.close()
+
+        (interval, leechers, seeders) = struct.unpack_from(">III", response, 8)
+        peers = parse_peers(response[20:], PEER6_LENGTH if ipv6 else PEER_LENGTH)
+
+        return Announce(interval, MIN_INTERVAL, peers, seeders, leechers)
+
+    async def connect(self, protocol):
+        def connect_packet(transaction_id):
+            return struct.pack(">QII", UDP_PROTOCOL_ID, UDP_CONNECT, transaction_id)
+
+        response = await self.exchange(protocol, connect_packet, UDP_CONNECT, 16)
+
+        self.connection_id = int.from_bytes(response[8:16], "big")
+        self.connected_at = time.monotonic()
+
+    ## send a request until a reply comes back, with the retransmit timeouts doubling every time
+    async def exchange(self, protocol, packet, action, min_length):
+        for attempt in range(UDP_RETRIES + 1):
+            transaction_id = random.getrandbits(32)
+
+            try:
+                response = await asyncio.wait_for(protocol.request(packet(transaction_id), transaction_id),
+                                                  UDP_TIMEOUT << attempt)
+            except asyncio.TimeoutError:
+                continue
+
+            (reply_action,) = struct.unpack_from(">I", response)
+            if reply_action == UDP_ERROR:
+                raise TrackerError(f"tracker refused - {response[8:].decode(errors='replace')}")
+
+            if reply_action != action or len(response) < min_length:
+                raise TrackerError("malformed response")
+
+            return response
+
+        raise TrackerError("udp tracker timed out")
+
+## client for a tracker url
+def tracker_for(url):
+    scheme = urllib.parse.urlsplit(url).scheme
+
+    if scheme in ("http", "https"):
+        return HTTPTracker(url)
+
+    if scheme == "udp":
+        return UDPTracker(url)
+
+    raise TrackerParseError(f"unsupported tracker - {url}")
+
+# A class that keeps the trackers of a torrent informed and collects peers
+# from them. The trackers are tried tier by tier (BEP 12) - within a tier
+# in random order, with one that answers moved to the front - and announced
+# to again every interval the tracker asks for, reporting what we actually
+# transferred.
+class Tracker:
+    def __init__(self, torrent, peer_id, port, progress):
+        self.info_hash = torrent.info_hash
+        self.peer_id = peer_id
+        self.port = port
+
+        # callable returning (uploaded, downloaded, left) in bytes
+        self.progress = progress
+
+        # called with the list of peers of every successful announce
+        self.on_peers = None
+
+        self.tiers = [random.sample(tier, len(tier)) for tier in torrent.trackers]
+        self.clients = {}
+
+        # identifies us to the trackers if our ip changes
+        self.key = random.getrandbits(32)
+
+        # started is sent until an announce goes through, completed once after the download finished
+        self.started = False
+        self.finished = False
+        self.completed_pending = False
+        self.wakeup = asyncio.Event()
+
+        # when the last announce went through, and how long the tracker wants us to wait between them
+        self.last_announce = None
+        self.min_interval = MIN_INTERVAL
+
+    ## the download finished, tell the trackers right away
+    def completed(self):
+        if self.finished:
+            return
+
+        self.finished = True
+        self.completed_pending = True
+        self.wakeup.set()
+
+    ## the event to send with the next announce
+    def next_event(self):
+        if not self.started:
+            return "started"
+
+        if self.completed_pending:
+            return "completed"
+
+        return ""
+
+    ## we are running out of peers, announce early if the tracker allows it
+    def request_peers(self):
+        # before the first announce went through the retry backoff decides
+        if self.last_announce is not None and time.monotonic() - self.last_announce >= self.min_interval:
+            self.wakeup.set()
+
+    ## announce to the first tracker that answers, tier by tier
+    async def announce(self, event):
+        (uploaded, downloaded, left) = self.progress()
+        error = None
+
+        for tier in self.tiers:
+            for url in list(tier):
+                try:
+                    client = self.clients.get(url)
+                    if client is None:
+                        client = self.clients[url] = tracker_for(url)
+
+                    result = await client.announce(self.info_hash, self.peer_id, self.port,
+                                                   uploaded, downloaded, left, event, self.key)
+                except (OSError, ValueError, asyncio.TimeoutError, TrackerError, TrackerParseError) as e:
+                    error = f"{url}: {e or type(e).__name__}"
+                    continue
+
+                # try this one first from now on
+                tier.remove(url)
+                tier.insert(0, url)
+
+                return result
+
+        raise TrackerError(error or "no trackers")
+
+    ## announce for as long as the torrent runs
+    async def run(self):
+        retry = RETRY_INTERVAL
+
+        while True:
+            event = self.next_event()
+            try:
+                result = await self.announce(event)
+            except TrackerError as e:
+                print(f"Could not announce - {e}")
+                delay = retry
+                retry = min(retry * 2, MAX_RETRY_INTERVAL)
+            else:
+                if event == "completed":
+                    self.completed_pending = False
+
+                self.started = True
+                self.last_announce = time.monotonic()
+                self.min_interval = max(result.min_interval or 0, MIN_INTERVAL)
+                retry = RETRY_INTERVAL
+
+                if self.on_peers is not None:
+                    self.on_peers(result.peers)
+
+                delay = max(result.interval, self.min_interval)
+
+                # the download finished while started was on its way
+                if self.completed_pending:
+                    delay = 0
+
+            # sleep out the interval, unless there is an event to send
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    ## tell the trackers we are leaving, without holding up shutdown for long
+    async def stop(self):
+        if not self.started:
+            return
+
+        try:
+            await asyncio.wait_for(self.announce_stopped(), STOP_TIMEOUT)
+        except (TrackerError, asyncio.TimeoutError):
+            pass
+
+    ## stopped, after a completed that hasn't gone through yet so the tracker still counts the download
+    async def announce_stopped(self):
+        if self.completed_pending:
+            try:
+                await self.announce("completed")
+                self.completed_pending = False
+            except TrackerError:
+                pass
+
+        await self.announce("stopped")
+
+## peers from a tracker response - compact entries of length bytes, or a list of dicts
+def parse_peers(peers, length=PEER_LENGTH):
+    if isinstance(peers, list):
+        parsed = []
+        for entry in peers:
+            try:
+                parsed.append(Peer(entry["ip"], entry["port"]))
+            except (KeyError, TypeError, ValueError):
+                pass
+
+        return parsed
+
+    # the decoder turns byte strings into str where it can, undo that
+    if isinstance(peers, str):
+        peers = peers.encode()
+
+    return [Peer.from_bytes(peers[i:i + length]) for i in range(0, len(peers) - len(peers) % length, length)]
+
+## undo chunked transfer encoding
+def _dechunk(body):
+    chunks = []
+    index = 0
+
+    while True:
+        end = body.find(b"\r\n", index)
+        if end < 0:
+            raise TrackerError("malformed chunked response")
+
+        try:
+            length = int(body[index:end].split(b";")[0], 16)
+        except ValueError:
+            raise TrackerError("malformed chunked response")
 
-        return decoded_response
+        if length == 0:
+            return b"".join(chunks)
 
-        
\ No newline at end of file
+        chunks.append(body[end + 2:end + 2 + length])
+        index = end + 4 + length
@@ -1,165 +1,88 @@
 from peer import Peer
 from message import *
-import struct
-from hashlib import sha1
+from stream import open_stream
+from rate import RateMeter
+from scheduler import BLOCK_SIZE
+import bitfield
 import asyncio
+import collections
+import hashlib
+import math
+import time
 
-class Worker:
-    def __init__(self, name, torrent, peer_id, peer_q, pieces_q, downloaded_q):
-        self.info_hash = torrent.info_hash
-        self.peer_id = peer_id
+# Bounds on the number of requests kept in flight with a peer
+MIN_REQUESTS = 4
+MAX_REQUESTS = 250
 
-        self.BLOCK_SIZE = 16384
-        self.NUM_REQUESTS = 10
+# Requests in flight before the peer's rate and latency are known
+INITIAL_REQUESTS = 10
 
-        self.state = {
-            "piplined_requests": 0,
-            "piece_buf": bytearray(b""),
-            "block_num": 0
-        }
+# Requests in flight as a multiple of the bandwidth-delay product, the headroom lets the rate grow
+PIPELINE_FACTOR = 2
 
-        self.peers = peer_q
-        self.pieces = pieces_q
-        self.downloaded_q = downloaded_q
-        self.name = name
+# Max number of requests from a peer we queue up, anything past this is dropped
+MAX_UPLOAD_REQUESTS = 250
 
-    async def run(self):
-        print(f"{self.name}: start!")
-        while self.pieces.qsize() > 0:
-            self.peer = await self.peers.get()
-
-            try:
-                self.stream = await self.connect(self.peer)
-            except Exception as e:
-                print(f"{self.name}: {e}")
-                self.peers.task_done()
-                continue
+# Largest block a peer may request from us
+MAX_UPLOAD_BLOCK = 1 << 17
 
-            # print(f"{self.name}: Connected to {self.peer.host.exploded}:{self.peer.port}")
+# Bit in the last reserved handshake byte that announces the fast extension (BEP 6)
+FAST_EXTENSION = 0x04
 
-            try:
-                handshake = await self.construct_handshake()
-                await self.exchange_handshakes(handshake)
-            except Exception as e:
-                print(f"{self.name}: {e}")
-                self.peers.task_done()
-                if not self.stream.is_closed(): await self.stream.close()
-                continue
-
-            try:
-                while self.pieces.qsize() > 0:
-                    if not self.peer.peer_choking:
-                        self.state = await self.get_valid_piece()
-
-                        try:
-                            await self.download_piece()
-
-                            if not self.verify_piece(bytes(self.state["piece_buf"])):
-                                await self.pieces.put((self.state["piece"]["index"], self.state["piece"]["hash"], self.state["piece"]["length"]))
-                                self.pieces.task_done()
-                                print("put")
-                                continue
-
-                            await self.downloaded_q.put((self.state["piece"]["index"], bytes(self.state["piece_buf"])))
-                            self.pieces.task_done()
-                            print("doned")
-                            print(f"{self.name} downloaded {self.state['piece']['index']}")
-                            print(f"{self.name}::::::::::::::::::::::::::::{self.pieces.qsize()}")
-                        except Exception as e:
-                            await self.pieces.put((self.state["piece"]["index"], self.state["piece"]["hash"], self.state["piece"]["length"]))
-                            self.pieces.task_done()
-                            print("put")
-                            # print(f"{self.name} Error!: {e}")
-                            raise e
-
-                    else:
-                        # print(f"{self.name} awaiting message")
-                        await asyncio.create_task(self.handle_message())
-
-                        if self.peer.client_choking and not self.peer.peer_choking:
-                            # print("{self.name} wrote interested")
-                            self.stream.write(Unchoke().construct())
-                            self.stream.write(Interested().construct())
-
-                            self.peer.client_choking = False
-                            self.peer.client_interested = True
-
-            except Exception as e:
-                print(f"{self.name} super Error!: {e}")
-                if not self.stream.is_closed(): await self.stream.close()
-                self.peers.task_done()
-                continue
-                break
+# Number of pieces a peer may download from us while choked, with the fast extension
+ALLOWED_FAST_PIECES = 10
 
-            print(f"Current: {self.pieces.qsize()}")
-            await self.stream.close()
+class Worker:
+    def __init__(self, name, torrent, peer_id, peer, scheduler, storage,
+                 min_requests=MIN_REQUESTS, max_requests=MAX_REQUESTS, incoming=False, seed=False, choker=None, limits=None):
+        self.torrent = torrent
+        self.info_hash = torrent.info_hash
+        self.peer_id = peer_id
 
-        print(f"{self.name}: Finished")
+        self.min_requests = min_requests
+        self.max_requests = max_requests
 
-    async def download_piece(self):
-        blocks_needed = self.state["piece"]["length"]/self.BLOCK_SIZE
+        self.peer = peer
+        self.peer.reset()
+        self.stream = None
+        self.scheduler = scheduler
+        self.picker = scheduler.picker
+        self.storage = storage
+        self.name = name
 
-        while blocks_needed > self.state["downloaded_blocks"]:
-            while self.state["pipelined_requests"] < self.NUM_REQUESTS and self.state["block_num"] < blocks_needed:
-                request_length = self.BLOCK_SIZE
-                
-                if (remaining_length := self.state["piece"]["length"] - self.state["block_num"] * self.BLOCK_SIZE) < self.BLOCK_SIZE:
-                    request_length = remaining_length
+        # the peer connected to us, so it sends its handshake first
+        self.incoming = incoming
 
-                request_msg = Request(self.state["piece"]["index"], 
-                                        self.state["block_num"] * self.BLOCK_SIZE, 
-                                        request_length)
+        # keep serving the peer after our download is done
+        self.seed = seed
 
-                self.stream.write(request_msg.construct())
-                await self.stream.drain()
+        # decides whether the peer gets an upload slot
+        self.choker = choker
 
-                self.state["block_num"] += 1
-                self.state["pipelined_requests"] += 1
+        # global bandwidth limits, the connection gets its own buckets on top
+        self.limits = limits
 
+        # per connection measurements used to size the request pipeline
+        self.download_rate = RateMeter()
+        self.min_rtt = None
+        self.request_times = {}
 
-            await asyncio.create_task(self.handle_message())
+        # set once the handshake went through
+        self.handshaked = False
 
-    async def get_valid_piece(self):
-        while True:
-            (piece_index, piece_hash, piece_length) = await self.pieces.get()
-            print("get")
-            try:
-                if not self.peer.has_bit(piece_index):
-                    # print("Peer does not have piece")
-                    await self.pieces.put((piece_index, piece_hash, piece_length))
-                    self.pieces.task_done()
-                    print("put")
-                    continue
-
-                state = {
-                    "pipelined_requests": 0,
-                    "piece": {
-                        "hash": piece_hash,
-                        "index": piece_index,
-                        "length": piece_length
-                    },
-                    "piece_buf": bytearray(piece_length),
-                    "block_num": 0,
-                    "downloaded_blocks": 0
-                }
-
-                return state
-            except:
-                await self.pieces.put((piece_index, piece_hash, piece_length))
-                self.pieces.task_done()
-                print("put")
-                continue
+        # both sides support the fast extension
+        self.fast = False
 
-    def verify_piece(self, piece):
-        piece = bytes(piece)
-        piece_hash = self.state["piece"]["hash"]
-        if sha1(piece).digest() != self.state["piece"]["hash"]:
-            return False
+        # pieces we let the peer download while it is choked
+        self.allowed_fast = set()
 
-        return True
+        # requests from the peer waiting to be served
+        self.upload_rate = RateMeter()
+        self.upload_queue = collections.deque()
+        self.upload_ready = asyncio.Event()
 
-    async def handle_message(self):
-        MSG_TYPE = {
+        # message id : handler
+        self.handlers = {
                 0 : self.handle_choke,
                 1 : self.handle_unchoke,
                 2 : self.handle_interested,
@@ -170,26 +93,216 @@ class Worker:
                 7 : self.handle_piece,
                 8 : self.handle_cancel,
             }
-        
+
+    ## talk to the connected peer until the download finishes or the connection drops
+    async def run(self):
+        if self.limits is not None:
+            self.stream.set_limits(*self.limits.for_peer())
+
+        try:
+            handshake = await self.construct_handshake()
+            if self.incoming:
+                await self.accept_handshake(handshake)
+            else:
+                await self.exchange_handshakes(handshake)
+            self.handshaked = True
+        except Exception:
+            if not self.stream.is_closed(): await self.stream.close()
+            return
+
+        if self.fast:
+            self.handlers.update({
+                    13 : self.handle_suggest,
+                    14 : self.handle_have_all,
+                    15 : self.handle_have_none,
+                    16 : self.handle_reject,
+                    17 : self.handle_allowed_fast,
+                })
+
+        self.send_pieces()
+
+        uploader = asyncio.ensure_future(self.upload())
+
+        try:
+            while self.seed or not self.picker.is_finished():
+                # ask to be unchoked once the peer has something we want
+                if self.peer.peer_choking and not self.peer.client_interested and self.picker.is_interesting(self.peer):
+                    self.stream.send(Interested())
+                    self.peer.client_interested = True
+
+                # pieces the peer allows us fast can be downloaded while choked
+                if not self.picker.is_finished() and (not self.peer.peer_choking or self.peer.allowed_fast):
+                    await self.request_blocks()
+
+                    # the peer has nothing we want right now
+                    if not self.scheduler.num_outstanding(self):
+                        await self.wait_for_piece()
+                        continue
+
+                    await self.handle_message()
+
+                else:
+                    await asyncio.create_task(self.handle_message())
+
+        except Exception:
+            # the connection dropped or the peer broke the protocol, either way we are done with it
+            pass
+
+        finally:
+            uploader.cancel()
+            self.scheduler.release(self)
+            self.picker.remove_bitfield(self.peer.bitfield)
+            if not self.stream.is_closed(): await self.stream.close()
+
+    ## tell the peer what we have, and what it may download before we unchoke it
+    def send_pieces(self):
+        have = self.storage.bitfield()
+        num_pieces = len(self.torrent.pieces)
+
+        if not self.fast:
+            if any(have):
+                self.stream.send(Bitfield(have))
+            return
+
+        # the fast extension has a message for each end of a download instead of a whole bitfield
+        count = len(bitfield.Bitfield.from_bytes(have, num_pieces))
+        if count == 0:
+            self.stream.send(HaveNone())
+        elif count == num_pieces:
+            self.stream.send(HaveAll())
+        else:
+            self.stream.send(Bitfield(have))
+
+        self.allowed_fast = allowed_fast_set(self.peer.host, self.info_hash, num_pieces)
+        for index in sorted(self.allowed_fast):
+            if self.storage.has_piece(index):
+                self.stream.send(AllowedFast(index))
+
+    ## serve queued requests from the file on disk
+    async def upload(self):
+        while True:
+            await self.upload_ready.wait()
+
+            while self.upload_queue:
+                (index, begin, length) = self.upload_queue.popleft()
+
+                # the block goes out as a view of the mapped file, the header is the only new bytes
+                block = await self.storage.read_block(index, begin, length)
+                await self.stream.write_block(Piece.header(index, begin, length), block)
+                self.upload_rate.add(length)
+
+                await self.stream.drain()
+
+            self.upload_ready.clear()
+
+    def is_connected(self):
+        return self.handshaked and not self.stream.is_closed()
+
+    def unchoke(self):
+        self.stream.send(Unchoke())
+        self.peer.client_choking = False
+
+    def choke(self):
+        self.stream.send(Choke())
+        self.peer.client_choking = True
+
+        # a choke discards everything the peer asked for, with the fast extension
+        # we say so for each request and keep serving the allowed fast pieces
+        if not self.fast:
+            self.upload_queue.clear()
+            return
+
+        kept = collections.deque()
+        for (index, begin, length) in self.upload_queue:
+            if index in self.allowed_fast:
+                kept.append((index, begin, length))
+            else:
+                self.stream.send(RejectRequest(index, begin, length))
+
+        self.upload_queue = kept
+
+    ## we finished a piece, let the peer know
+    def send_have(self, index):
+        if self.handshaked and not self.stream.is_closed():
+            self.stream.send(Have(index))
+
+    ## drop the connection, run() notices and cleans up
+    def close(self):
+        if self.stream is not None:
+            self.stream.transport.close()
+
+    ## wait for either the peer to tell us about new pieces or another worker to give one up
+    async def wait_for_piece(self):
+        message = asyncio.ensure_future(self.handle_message())
+        changed = asyncio.ensure_future(self.picker.wait_changed())
+
+        try:
+            done, pending = await asyncio.wait({message, changed}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            # also when we are cancelled while waiting, or the read would outlive the worker
+            message.cancel()
+            changed.cancel()
+
+            # let the cancelled tasks finish so any error they raised on the way out is retrieved
+            await asyncio.gather(message, changed, return_exceptions=True)
+
+        # raise any error from reading the message
+        if message in done:
+            message.result()
+
+    ## number of requests to keep in flight - enough to cover the peer's bandwidth-delay product
+    def queue_depth(self):
+        if self.min_rtt is None:
+            depth = INITIAL_REQUESTS
+        else:
+            bdp = self.download_rate.rate() * self.min_rtt / BLOCK_SIZE
+            depth = math.ceil(bdp * PIPELINE_FACTOR)
+
+        return max(self.min_requests, min(self.max_requests, depth))
+
+    ## top the pipeline up with blocks from the scheduler
+    async def request_blocks(self):
+        count = self.queue_depth() - self.scheduler.num_outstanding(self)
+
+        # while choked only the allowed fast pieces can be requested
+        allowed = self.peer.allowed_fast if self.peer.peer_choking else None
+        requests = self.scheduler.request_blocks(self, self.peer, count, allowed)
+
+        if not requests:
+            return
+
+        now = time.monotonic()
+        for (index, begin, length) in requests:
+            self.request_times[(index, begin)] = now
+
+        # the requests are packed into the send buffer and go out in one write
+        for (index, begin, length) in requests:
+            self.stream.send(Request(index, begin, length))
+        await self.stream.drain()
+
+    ## the scheduler got this block from someone else, called from another worker's task
+    def cancel_block(self, index, begin, length):
+        if not self.stream.is_closed():
+            self.stream.send(Cancel(index, begin, length))
+
+    async def handle_message(self):
         while True:
-            msg_length = int.from_bytes(await self.stream.read(4), byteorder="big")
-            raw_message = await self.stream.read(msg_length)
-            msg = parse_message(raw_message)
+            # the message body is a view into the stream's receive buffer, handlers must not hold on to it
+            msg = parse_message(await self.stream.read_message())
 
             if isinstance(msg, KeepAlive): 
-                # print("KeepAlive")
                 continue
             
-            MSG_TYPE[msg.id](msg)
+            self.handlers[msg.id](msg)
             break
 
     ## create a connection with a peer
-    async def connect(self, peer):
-        # print(f"{self.name}: Attempting {peer.host.exploded}:{peer.port}...")
-        conn = asyncio.open_connection(host=peer.host.exploded, port=peer.port)
+    async def connect(self, timeout=3):
+        peer = self.peer
+        conn = open_stream(host=peer.host.exploded, port=peer.port)
         
         try:
-            reader, writer = await asyncio.wait_for(conn, timeout=3)
+            self.stream = await asyncio.wait_for(conn, timeout=timeout)
         except asyncio.TimeoutError:
             raise AsyncConnectionError(f"{self.name} {peer} connection attempt timed out")
         except ConnectionRefusedError:
@@ -197,7 +310,7 @@ class Worker:
         except Exception as e:
             raise AsyncConnectionError(f"{self.name} error - {e}")
 
-        return AsyncStream(reader, writer)
+        self.connected_at = time.monotonic()
 
     ## exchange a handshake with a peer
     async def exchange_handshakes(self, handshake):
@@ -206,14 +319,27 @@ class Worker:
         await self.stream.drain()
 
         response = await self.stream.read(68)
-        # print(f"{self.name} exchanged handshake")
 
         if not await self.valid_handshake(response):
             raise InvalidHandshake
 
+        self.fast = bool(response[27] & FAST_EXTENSION)
+
+    ## answer a handshake from a peer that connected to us
+    async def accept_handshake(self, handshake):
+        response = await self.stream.read(68)
+
+        if not await self.valid_handshake(response):
+            raise InvalidHandshake
+
+        self.fast = bool(response[27] & FAST_EXTENSION)
+
+        self.stream.write(handshake)
+        await self.stream.drain()
+
     ## constructs a handshake to send to peers
     async def construct_handshake(self):
-        handshake = b"\x13BitTorrent protocol\x00\x00\x00\x00\x00\x00\x00\x00"
+        handshake = b"\x13BitTorrent protocol\x00\x00\x00\x00\x00\x00\x00" + bytes([FAST_EXTENSION])
         handshake += self.info_hash
         handshake += self.peer_id
 
@@ -227,48 +353,119 @@ class Worker:
         # make sure it is the correct file
         if handshake[28:48] != self.info_hash : return False
 
+        # the tracker handed us our own address
+        if handshake[48:68] == self.peer_id : return False
+
         return True
 
     def handle_choke(self, msg):
-        # print(f"{self.name} Choked")
         self.peer.peer_choking = True
 
+        # a choke discards every request we have pending with the peer,
+        # unless it rejects the ones it drops one by one (fast extension)
+        if not self.fast:
+            self.scheduler.release(self)
+            self.request_times.clear()
+
     def handle_unchoke(self, msg):
-        # print(f"{self.name} Unchoked")
         self.peer.peer_choking = False
 
     def handle_interested(self, msg):
-        # print(f"{self.name} Interested")
         self.peer.peer_interested = True
 
+        if self.choker is not None:
+            self.choker.peer_interested(self)
+        elif self.peer.client_choking:
+            self.unchoke()
+
     def handle_uninterested(self, msg):
-        # print(f"{self.name} Uninterested")
         self.peer.peer_interested = False
 
     def handle_have(self, msg):
-        # print(f"{self.name} Have")
-        self.peer.set_bit(msg.piece_index, 1)
+        index = msg.piece_index
+        if index >= len(self.torrent.pieces) or index in self.peer.bitfield:
+            return
+
+        self.peer.bitfield.add(index)
+        self.picker.peer_has(index)
 
     def handle_bitfield(self, msg):
-        # print(f"{self.name} Bitfield")
-        self.peer.bitfield = bytearray(msg.bitfield)
+        self.picker.remove_bitfield(self.peer.bitfield)
+
+        self.peer.bitfield = bitfield.Bitfield.from_bytes(msg.bitfield, len(self.torrent.pieces))
+        self.picker.add_bitfield(self.peer.bitfield)
 
     def handle_request(self, msg):
-        print(f"{self.name} Request")
+        if not self.can_serve(msg):
+            # with the fast extension the peer hears about it right away instead of timing out
+            if self.fast:
+                self.stream.send(RejectRequest(msg.index, msg.begin, msg.request_length))
+            return
+
+        self.upload_queue.append((msg.index, msg.begin, msg.request_length))
+        self.upload_ready.set()
+
+    ## whether a request from the peer is one we will serve
+    def can_serve(self, msg):
+        if self.peer.client_choking and msg.index not in self.allowed_fast:
+            return False
+
+        if len(self.upload_queue) >= MAX_UPLOAD_REQUESTS:
+            return False
+
+        # only serve whole blocks of pieces we have on disk
+        if msg.index >= len(self.torrent.pieces) or msg.request_length > MAX_UPLOAD_BLOCK:
+            return False
+
+        if not self.storage.has_piece(msg.index):
+            return False
+
+        return msg.begin + msg.request_length <= self.torrent.get_piece_length(msg.index)
 
     def handle_piece(self, msg):
-        # print(f"{self.name} Piece")
-        if msg.index != self.state["piece"]["index"]:
-            raise ValueError
+        self.download_rate.add(len(msg.block))
 
-        block_length = len(msg.block)
+        sent = self.request_times.pop((msg.index, msg.begin), None)
+        if sent is not None:
+            rtt = time.monotonic() - sent
+            if self.min_rtt is None or rtt < self.min_rtt:
+                self.min_rtt = rtt
 
-        self.state["piece_buf"][msg.begin:msg.begin+block_length] = msg.block
-        self.state["pipelined_requests"] -= 1
-        self.state["downloaded_blocks"] += 1
+        self.scheduler.block_received(self, msg.index, msg.begin, msg.block)
 
     def handle_cancel(self, msg):
-        print(f"{self.name} Cancel")
+        try:
+            self.upload_queue.remove((msg.index, msg.begin, msg.request_length))
+        except ValueError:
+            return
+
+        # with the fast extension every request gets either its block or a reject
+        if self.fast:
+            self.stream.send(RejectRequest(msg.index, msg.begin, msg.request_length))
+
+    ## a hint about what to download next, the picker has its own ideas
+    def handle_suggest(self, msg):
+        pass
+
+    def handle_have_all(self, msg):
+        self.picker.remove_bitfield(self.peer.bitfield)
+
+        self.peer.bitfield = bitfield.Bitfield.full(len(self.torrent.pieces))
+        self.picker.add_bitfield(self.peer.bitfield)
+
+    def handle_have_none(self, msg):
+        self.picker.remove_bitfield(self.peer.bitfield)
+
+        self.peer.bitfield = bitfield.Bitfield()
+
+    ## the peer won't send a block we asked for, someone else can have it now
+    def handle_reject(self, msg):
+        self.request_times.pop((msg.index, msg.begin), None)
+        self.scheduler.block_rejected(self, msg.index, msg.begin)
+
+    def handle_allowed_fast(self, msg):
+        if msg.piece_index < len(self.torrent.pieces):
+            self.peer.allowed_fast.add(msg.piece_index)
 
 
 
@@ -278,39 +475,25 @@ class InvalidHandshake(Exception):
 class AsyncConnectionError(Exception):
     pass
 
-class AsyncStream:
-    def __init__(self, reader, writer):
-        self.reader = reader
-        self.writer = writer
-
-    async def read(self, nbytes: int):
-        a = await asyncio.wait_for(asyncio.create_task(self.read_internal(nbytes)), timeout=150)
-        return a
+## the pieces a peer at host may download from us while choked, which every
+## client works out the same way from its /24 network and the info hash (BEP 6)
+def allowed_fast_set(host, info_hash, num_pieces, count=ALLOWED_FAST_PIECES):
+    allowed = set()
 
-    async def read_internal(self, nbytes: int):
-        response = b""
-        counter = 0
-        while nbytes != 0:
-            recieved_data = await asyncio.wait_for(self.reader.read(nbytes), 2)
+    # the algorithm is only defined for ipv4
+    if host.version != 4:
+        return allowed
 
-            if recieved_data:
-                nbytes -= len(recieved_data)
-                response += recieved_data
-            # if len(recieved_data) != 0:
-            #     print(f"Recieved {len(recieved_data)} bytes")
+    count = min(count, num_pieces)
+    x = (int(host) & 0xFFFFFF00).to_bytes(4, "big") + info_hash
 
-        # print(f"response length: {len(response)}")
-        return response
+    while len(allowed) < count:
+        x = hashlib.sha1(x).digest()
 
-    def write(self, bytestring: bytes):
-        self.writer.write(bytestring)
-
-    async def drain(self):
-        await self.writer.drain()
+        for i in range(0, 20, 4):
+            if len(allowed) == count:
+                break
 
-    async def close(self):
-        self.writer.close()
-        await self.writer.wait_closed()
+            allowed.add(int.from_bytes(x[i:i + 4], "big") % num_pieces)
 
-    def is_closed(self):
-        return self.writer.is_closing()
\ No newline at end of file
+    return allowed